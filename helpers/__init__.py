@@ -1,6 +1,3 @@
-
-# import utility classes
-from .display import Display
-from .ledout import LED
-from .classes import LichtWecker
-from .audio import Audio
\ No newline at end of file
+# the modules are imported where they are used (from helpers.audio import
+# Audio, ...), importing the package itself only starts the profiler
+from . import profiler
@@ -1,15 +1,75 @@
 from mpd import MPDClient, MPDError
+from mpd import ConnectionError as MPDConnectionError
+import logging
+import threading
 import time
 import RPi.GPIO as GPIO
+from . import easing
+from .titlecatalog import TitleCatalog
+from .playlistwindow import PlaylistWindow
 
 class Audio(object):
     
     MUSIC_DIR = "usbstick"
+
+    # connection handling
+    IDLE_THRESHOLD = 10.0     # ping before using a connection idle for longer (seconds)
+    RECONNECT_ATTEMPTS = 3
+    RECONNECT_BACKOFF = 0.1   # first wait between attempts, doubled every time
+    MAX_BACKOFF = 30.0        # longest time we refuse to try again after failing
+
+    FADE_INTERVAL = 0.2       # how often a running volume fade is re-evaluated (seconds)
     
-    def __init__(self):
+    def __init__(self, host="localhost", port="6600", timeout=10):
+
+        self.host = host
+        self.port = port
 
         self._mpc = MPDClient()
-        self._reconnect()
+        self._mpc.timeout = timeout # socket timeout, so a hanging MPD can't block us forever
+        self._lock = threading.RLock()
+        self._connected = False
+        self._last_used = 0.0
+        self._retry_after = 0.0
+        self._backoff = self.RECONNECT_BACKOFF
+
+        # statistics, to see how MPD behaves at alarm time
+        self.reconnects = 0
+        self.commands = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.last_rtt = 0.0
+        self.max_rtt = 0.0
+        self.avg_rtt = 0.0
+
+        # title cache, kept valid by the idle listener thread. The generation
+        # is bumped on every playlist/database change MPD reports.
+        self._cache_lock = threading.Lock()
+        self._titles = None
+        self._titles_generation = -1
+        self._titles_version = None
+        self._generation = 0
+        self._idle_alive = False
+        self._catalog = None # TitleCatalog of self._titles
+        self._uri_ids = {} # file -> song id, for the songs in self._titles
+        self._window = None # PlaylistWindow, for browsing without the whole list
+
+        self._fade_stop = None # threading.Event of the running volume fade
+
+        # music rescan running in MPD (see refresh_music_dir)
+        self._rescan_lock = threading.Lock()
+        self._rescan_job = None # MPD's update job id, None if none is running
+        self._rescan_started = None
+        self._rescan_finished = None
+        self._rebuild_pending = False # waits for the music to stop
+
+        try:
+            self._ensure_connected()
+        except MPDError:
+            logging.warning("MPD not reachable at startup, will retry on first use")
+
+        self._idle_thread = threading.Thread(target=self._idle_listener, name="MPDIdle", daemon=True)
+        self._idle_thread.start()
         self.volume = 95
         
         # fix to remove the crackling noises in the loudspeaker
@@ -17,64 +77,452 @@ class Audio(object):
         GPIO.setup(27, GPIO.OUT, initial=GPIO.HIGH)
         
     def set_vol(self, volume):
+        self.cancel_fade()
         self.volume = volume
-        self._reconnect()
-        self._mpc.setvol(volume)
+        self._command("setvol", volume)
 
-    def playid(self, songid):
+    def playid(self, songid, volume=None):
+        """ play song songid, at volume or if not given the configured volume """
         print ("PlayID: {}".format(songid))
-        self._reconnect()
         
+        if (volume is None):
+            volume = self.volume
+
         # enable amplifier 
         GPIO.output(27, GPIO.LOW)
         
-        self._mpc.playid(songid)
-        self._mpc.setvol(self.volume)
+        # volume first, so the first sample is not played at the old volume
+        self._command_list([
+            ("setvol", volume),
+            ("playid", songid),
+        ])
         
         
     def playsingle(self, songfile):
-        self._reconnect()
-        self._mpc.clear()
-        self._mpc.add(songfile)
 
         # enable amplifier 
         GPIO.output(27, GPIO.LOW)
 
-        self._mpc.play()
-        self._mpc.setvol(self.volume)
+        self._command_list([
+            ("clear",),
+            ("add", songfile),
+            ("setvol", self.volume),
+            ("play",),
+        ])
 
         
+    def play_uri(self, uri, fallback=None, volume=None):
+        """ play the song with the file uri from the playlist. If it is not
+            there, play fallback or else the first song. The id comes from 
+            memory, the playlist is never downloaded for this.
+        """
+        songid = self.song_id(uri) if uri else None
+        if (songid is None and fallback):
+            logging.warning("{} not in the playlist, playing {}".format(uri, fallback))
+            songid = self.song_id(fallback)
+        if (songid is None):
+            with self._cache_lock:
+                if (self._titles):
+                    songid = self._titles[0]["id"]
+        if (songid is None):
+            # we know nothing about the playlist (MPD was away), let MPD
+            # add the file again, that is one short command
+            songid = self._command("addid", uri or fallback)
+        self.playid(songid, volume)
+
+    def song_id(self, uri):
+        """ id of the song with the file uri in the playlist, None if it is not there """
+        with self._cache_lock:
+            songid = self._uri_ids.get(uri)
+            if (songid is None and self._titles):
+                # the map keeps one id per file, a file may be in the playlist twice
+                for title in self._titles:
+                    if (title.get("file") == uri):
+                        return title["id"]
+            return songid
+
+    def uri_at(self, position):
+        """ file uri of the song at position in the playlist, None if there is none """
+        if (position < 0):
+            return None
+        with self._cache_lock:
+            titles = self._titles
+        if (titles is not None):
+            return titles[position].get("file") if position < len(titles) else None
+        # just this one entry, not the whole playlist
+        try:
+            songs = self.playlistinfo(position, position + 1)
+        except MPDError:
+            return None
+        return songs[0].get("file") if songs else None
+
     def stop(self):
-        self._reconnect()
-        self._mpc.stop()
+        self.cancel_fade()
+        self._command("stop")
 
         # disable amplifier 
         GPIO.output(27, GPIO.HIGH)
 
+        if (self._rebuild_pending):
+            # a rescan finished while the music was playing
+            self._rebuild_playlist()
+
+    def fade_volume(self, start, target, duration, curve="log"):
+        """ ramp the volume from start to target over duration seconds in a
+            background thread. setvol is only sent when the integer volume 
+            changes. A running fade is replaced, stop() ends it.
+        """
+        self.cancel_fade()
+        stop = threading.Event()
+        self._fade_stop = stop
+        threading.Thread(
+            target=self._run_fade, 
+            args=(start, target, duration, easing.get(curve), stop), 
+            name="VolumeFade", 
+            daemon=True,
+            ).start()
+
+    def cancel_fade(self):
+        if (self._fade_stop is not None):
+            self._fade_stop.set()
+            self._fade_stop = None
+
+    def _run_fade(self, start, target, duration, curve, stop):
+        started = time.monotonic()
+        last_volume = None
+        while (not stop.is_set()):
+            if (duration > 0):
+                progress = min(1.0, (time.monotonic() - started) / duration)
+            else:
+                progress = 1.0
+            volume = int(round(start + (target - start) * curve(progress)))
+            if (volume != last_volume):
+                with self._lock:
+                    # cancelled while we waited for the connection
+                    if (stop.is_set()):
+                        break
+                    try:
+                        self._command("setvol", volume)
+                        last_volume = volume
+                    except MPDError:
+                        logging.warning("volume fade: setvol {0:d} failed".format(volume))
+            if (progress >= 1.0):
+                break
+            stop.wait(self.FADE_INTERVAL)
+
         
     def refresh_music_dir(self):
+        """ read in the music again, without waiting for it: MPD updates its
+            database in the background, once it is done the playlist is 
+            rebuilt (see _check_rescan). Returns MPD's update job id, None 
+            if MPD could not be asked.
+        """
         try:
-            self._reconnect()
-            self._mpc.clear()
-            self._mpc.update()
-            self._mpc.add(Audio.MUSIC_DIR)
-        except MPDError:
-            pass
+            job = int(self._command("update"))
+        except (MPDError, ValueError, TypeError) as error:
+            logging.error("music rescan not started: {}".format(error))
+            return None
+        with self._rescan_lock:
+            self._rescan_job = job
+            self._rescan_started = time.monotonic()
+            self._rescan_finished = None
+        logging.info("music rescan started, job {0:d}".format(job))
+        return job
+
+    def rescan_progress(self):
+        """ how the rescan is doing: dict with running, elapsed (seconds) 
+            and songs (in MPD's database so far)
+        """
+        status, stats = self._command_list([("status",), ("stats",)])
+        self._check_rescan(status)
+        with self._rescan_lock:
+            if (self._rescan_started is None):
+                elapsed = 0.0
+            else:
+                elapsed = (self._rescan_finished or time.monotonic()) - self._rescan_started
+            return {
+                "running": self._rescan_job is not None,
+                "elapsed": elapsed,
+                "songs": int(stats.get("songs", 0)),
+            }
+
+    def _check_rescan(self, status):
+        """ rebuild the playlist once the rescan job is no longer running.
+            Called with MPD's status from the idle listener on update events,
+            and from rescan_progress.
+        """
+        with self._rescan_lock:
+            if (self._rescan_job is None):
+                return
+            updating = status.get("updating_db")
+            if (updating is not None and int(updating) <= self._rescan_job):
+                # ours, or one before ours, is still running
+                return
+            logging.info("music rescan job {0:d} done".format(self._rescan_job))
+            self._rescan_job = None
+            self._rescan_finished = time.monotonic()
+            if (status.get("state") == "play"):
+                # clearing the playlist would stop the music (the alarm)
+                self._rebuild_pending = True
+                return
+        self._rebuild_playlist()
+
+    def _rebuild_playlist(self):
+        self._rebuild_pending = False
+        try:
+            self._command_list([
+                ("clear",),
+                ("add", Audio.MUSIC_DIR),
+            ])
+        except MPDError as error:
+            logging.error("playlist not rebuilt: {}".format(error))
 
     def get_titles_info(self):
-        self._reconnect()
+        """ the playlist (list of dicts like MPD's playlistid returns them).
+            Served from the cache unless MPD reported a change since.
+        """
+        with self._cache_lock:
+            generation = self._generation
+            if (self._titles is not None and self._titles_generation == generation):
+                if (self._idle_alive):
+                    self.cache_hits += 1
+                    return self._titles
+                cached_version = self._titles_version
+            else:
+                cached_version = None
+
         try:
-            playlistid = self._mpc.playlistid()
-            return playlistid
+            # no idle listener to tell us about changes, so compare versions
+            version = self._command("status").get("playlist")
+            if (cached_version is not None and version == cached_version):
+                self.cache_hits += 1
+                return self._titles
+            playlistid = self._command("playlistid")
         except MPDError:
             return []
+
+        self.cache_misses += 1
+        self._store_titles(playlistid, version, generation)
+        return playlistid
+
+    def get_title_catalog(self):
+        """ TitleCatalog of the playlist, rebuilt only when the playlist changed """
+        titles = self.get_titles_info()
+        with self._cache_lock:
+            if (self._catalog is None or self._catalog.titles is not titles):
+                self._catalog = TitleCatalog(titles)
+            return self._catalog
+
+    def playlist_window(self):
+        """ PlaylistWindow on the playlist, checked against MPD's playlist version """
+        if (self._window is None):
+            self._window = PlaylistWindow(self)
+        self._window.refresh()
+        return self._window
+
+    def playlist_version(self):
+        """ (version, length) of MPD's playlist """
+        status = self._command("status")
+        return (status.get("playlist"), int(status.get("playlistlength", 0)))
+
+    def playlistinfo(self, start, end):
+        """ playlist entries from position start up to (not including) end """
+        return self._command("playlistinfo", "{0:d}:{1:d}".format(start, end))
+
+    def find_in_playlist(self, uri):
+        """ position of the file uri in the playlist, None if it is not there """
+        songs = self._command("playlistfind", "file", uri)
+        if (songs):
+            return int(songs[0]["pos"])
+        return None
+
+    def _store_titles(self, titles, version, generation):
+        with self._cache_lock:
+            # a change reported while we were fetching makes the result stale
+            if (generation == self._generation):
+                self._titles = titles
+                self._titles_version = version
+                self._titles_generation = generation
+                self._uri_ids = dict((title.get("file"), title["id"]) for title in titles)
+
+    def _patch_titles(self, known_version, changes, length, version, generation):
+        """ apply what plchanges reported since known_version to the cached
+            playlist and the uri map, instead of downloading all of it.
+            False if the cache moved on meanwhile.
+        """
+        with self._cache_lock:
+            if (generation != self._generation or self._titles_version != known_version):
+                return False
+            self._titles_version = version
+            self._titles_generation = generation
+            if (not changes and length == len(self._titles)):
+                # the database changed, the playlist did not
+                return True
+
+            titles = self._titles[:length]
+            changed = [(int(song["pos"]), song) for song in changes]
+
+            # first forget the songs that were replaced or dropped, then add
+            # the new ones: a moved song keeps its id, it must not get lost
+            gone = [titles[position] for position, song in changed if position < len(titles)]
+            gone.extend(self._titles[length:])
+            for title in gone:
+                if (self._uri_ids.get(title.get("file")) == title["id"]):
+                    del self._uri_ids[title.get("file")]
+
+            for position, song in changed:
+                if (position >= len(titles)):
+                    titles.extend([None] * (position + 1 - len(titles)))
+                titles[position] = song
+                self._uri_ids[song.get("file")] = song["id"]
+
+            # a new list, so whoever holds the old one (catalogue) sees the change
+            self._titles = titles
+            return True
+
+    def _invalidate_titles(self):
+        with self._cache_lock:
+            self._generation += 1
+            return self._generation
+
+    def _idle_listener(self):
+        """ runs in its own thread with its own connection (idle blocks it).
+            Drops the title cache when MPD reports playlist or database 
+            changes and refills it right away, so lookups at alarm time 
+            are answered from memory. Update events finish music rescans.
+        """
+        client = MPDClient()
+        backoff = self.RECONNECT_BACKOFF
+        while True:
+            try:
+                client.connect(self.host, self.port)
+                backoff = self.RECONNECT_BACKOFF
+                self._idle_alive = True
+                # events may have been missed while we were not listening
+                changed = ["playlist", "update"]
+                while True:
+                    if ("playlist" in changed or "database" in changed):
+                        with self._cache_lock:
+                            known_version = self._titles_version if self._titles is not None else None
+                        generation = self._invalidate_titles()
+                        status = client.status()
+                        version = status.get("playlist")
+                        if (known_version is None):
+                            self._store_titles(client.playlistid(), version, generation)
+                        else:
+                            # only the songs that changed since the cached version
+                            changes = client.plchanges(known_version) if version != known_version else []
+                            if (not self._patch_titles(known_version, changes, int(status.get("playlistlength", 0)), version, generation)):
+                                self._store_titles(client.playlistid(), version, generation)
+                    if ("update" in changed or "database" in changed):
+                        self._check_rescan(client.status())
+                    changed = client.idle("playlist", "database", "update")
+            except (MPDError, OSError):
+                self._idle_alive = False
+                try:
+                    client.disconnect()
+                except (MPDError, OSError):
+                    pass
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+    def stats(self):
+        return {
+            "connected": self._connected,
+            "reconnects": self.reconnects,
+            "commands": self.commands,
+            "last_rtt": self.last_rtt,
+            "max_rtt": self.max_rtt,
+            "avg_rtt": self.avg_rtt,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+
+    def _command(self, name, *args):
+        """ send a command over the persistent connection. If the connection 
+            turns out to be dead, it is re-established and the command is 
+            sent once more.
+        """
+        return self._command_list([(name,) + args], single=True)
+
+    def _command_list(self, commands, single=False):
+        """ send several commands as one MPD command list, so they cost a 
+            single round trip. commands is a list of (name, arg, ...) tuples,
+            the results are returned as a list in the same order.
+        """
+        with self._lock:
+            for attempt in range(2):
+                self._ensure_connected()
+                started = time.monotonic()
+                try:
+                    if (single):
+                        name = commands[0][0]
+                        result = getattr(self._mpc, name)(*commands[0][1:])
+                    else:
+                        self._mpc.command_list_ok_begin()
+                        for command in commands:
+                            getattr(self._mpc, command[0])(*command[1:])
+                        result = self._mpc.command_list_end()
+                except (MPDConnectionError, OSError):
+                    self._drop_connection()
+                    if (attempt > 0):
+                        raise MPDConnectionError("MPD connection lost during {}".format([c[0] for c in commands]))
+                    continue
+                self._record_rtt(time.monotonic() - started)
+                return result
     
-    def _reconnect(self):
+    def _ensure_connected(self):
+        now = time.monotonic()
+        if (self._connected):
+            if (now - self._last_used < self.IDLE_THRESHOLD):
+                return
+            # connection idle for a while, MPD may have dropped it meanwhile
+            try:
+                self._mpc.ping()
+                self._last_used = time.monotonic()
+                return
+            except (MPDError, OSError):
+                self._drop_connection()
+
+        if (now < self._retry_after):
+            raise MPDConnectionError("MPD unreachable, next attempt in {0:.1f}s".format(self._retry_after - now))
+
+        delay = self.RECONNECT_BACKOFF
+        for attempt in range(self.RECONNECT_ATTEMPTS):
+            try:
+                self._mpc.connect(self.host, self.port)
+            except (MPDError, OSError):
+                self._drop_connection()
+                if (attempt < self.RECONNECT_ATTEMPTS - 1):
+                    time.sleep(delay)
+                    delay *= 2
+                continue
+            self._connected = True
+            self._last_used = time.monotonic()
+            self._backoff = self.RECONNECT_BACKOFF
+            self.reconnects += 1
+            logging.info("MPD connection established (#{0:d})".format(self.reconnects))
+            return
+
+        # give MPD some time before hammering it again
+        self._backoff = min(self._backoff * 2, self.MAX_BACKOFF)
+        self._retry_after = time.monotonic() + self._backoff
+        raise MPDConnectionError("could not connect to MPD at {}:{}".format(self.host, self.port))
+
+    def _drop_connection(self):
+        self._connected = False
         try:
-            self._mpc.connect('localhost','6600')
-        except MPDError:
             self._mpc.disconnect()
-            self._mpc.connect('localhost','6600')
+        except (MPDError, OSError):
+            pass
+
+    def _record_rtt(self, rtt):
+        self._last_used = time.monotonic()
+        self.commands += 1
+        self.last_rtt = rtt
+        self.max_rtt = max(self.max_rtt, rtt)
+        # moving average, recent commands count most
+        self.avg_rtt = rtt if self.commands == 1 else 0.9 * self.avg_rtt + 0.1 * rtt
     
 
 """
@@ -0,0 +1,151 @@
+import unicodedata
+
+'''
+
+Charset: text to HD44780 character codes (character ROM A00)
+
+ASCII mostly is where it belongs, a few other characters the ROM has
+somewhere in its upper half (the rest of which is katakana). Everything
+else falls back to something readable: accents are dropped, Ä becomes
+ä, unknown characters become "?". Display puts characters which have a
+glyph into CGRAM first, only without a free slot they end up here.
+
+encode() goes through str.translate with one table, so it runs at C
+speed. The table holds the ROM characters from the start, fallbacks are
+worked out the first time a character shows up and kept.
+
+'''
+
+# characters the A00 ROM has outside of ASCII
+ROM_A00 = {
+    "ä": 0xE1,
+    "ö": 0xEF,
+    "ü": 0xF5,
+    "ß": 0xE2,
+    "°": 0xDF,
+    "µ": 0xE4,
+    "μ": 0xE4,
+    "α": 0xE0,
+    "β": 0xE2,
+    "ε": 0xE3,
+    "σ": 0xE5,
+    "ρ": 0xE6,
+    "√": 0xE8,
+    "¢": 0xEC,
+    "ñ": 0xEE,
+    "θ": 0xF2,
+    "∞": 0xF3,
+    "Ω": 0xF4,
+    "Σ": 0xF6,
+    "π": 0xF7,
+    "÷": 0xFD,
+    "█": 0xFF,
+    "·": 0xA5,
+    "¥": 0x5C,
+    "→": 0x7E,
+    "←": 0x7F,
+}
+
+# where the ROM differs from ASCII, or there is no sensible decomposition
+FALLBACKS = {
+    "\\": "/", # 0x5C is ¥
+    "~": "-", # 0x7E is an arrow
+    "Ä": "ä",
+    "Ö": "ö",
+    "Ü": "ü",
+    "ẞ": "ß",
+    "„": '"',
+    "“": '"',
+    "”": '"',
+    "«": '"',
+    "»": '"',
+    "‚": "'",
+    "‘": "'",
+    "’": "'",
+    "´": "'",
+    "`": "'",
+    "–": "-",
+    "—": "-",
+    "…": "...",
+    "×": "x",
+    "€": "E",
+    "Æ": "AE",
+    "æ": "ae",
+    "Ø": "O",
+    "ø": "o",
+    "Œ": "OE",
+    "œ": "oe",
+    "ł": "l",
+    "Ł": "L",
+    "đ": "d",
+    "Đ": "D",
+    "\t": " ",
+    # glyphs (see glyphs.py) when no CGRAM slot is left
+    "🔔": "A",
+    "▏": " ",
+    "▎": " ",
+    "▍": "|",
+    "▌": "|",
+}
+
+UNKNOWN = "?"
+
+# codes 0 ... 7 are the user defined CGRAM characters, they pass unchanged
+CGRAM_CODES = 8
+
+
+def fallback(char):
+    """ text of ROM characters for char, which has no code of its own """
+    if (char in FALLBACKS):
+        return "".join(translate_char(c) for c in FALLBACKS[char])
+    if (unicodedata.combining(char)):
+        # an accent NFC could not put onto its letter
+        return ""
+    # é -> e + accent, keep what is left
+    decomposed = "".join(c for c in unicodedata.normalize("NFKD", char) if not unicodedata.combining(c))
+    if (decomposed and decomposed != char):
+        return "".join(translate_char(c) for c in decomposed)
+    return UNKNOWN
+
+
+def translate_char(char):
+    """ char as text of ROM codes (chr(code) for every code) """
+    code = ord(char)
+    if (char in ROM_A00):
+        return chr(ROM_A00[char])
+    if (code < CGRAM_CODES or (0x20 <= code < 0x7F and char not in FALLBACKS)):
+        return char
+    if (code < 0x20):
+        # control characters
+        return " "
+    return fallback(char)
+
+
+class _Table(dict):
+    """ str.translate table, characters seen for the first time are added """
+
+    def __missing__(self, code):
+        value = translate_char(chr(code))
+        self[code] = value
+        return value
+
+
+TABLE = _Table()
+for _code in range(0x80):
+    TABLE[_code] = translate_char(chr(_code))
+for _char in ROM_A00:
+    TABLE[ord(_char)] = translate_char(_char)
+
+
+def normalize(text):
+    """ composed characters: file names from macOS come decomposed (u +
+        combining diaeresis), the table and the glyphs know ü
+    """
+    return unicodedata.normalize("NFC", text)
+
+
+def encode(text):
+    """ bytes for the display. May be longer than text, where a character
+        is spelled out with several ("…" -> "...")
+    """
+    return normalize(text).translate(TABLE).encode("latin-1")
@@ -1,23 +1,30 @@
 from circuits import Component, Event, Timer
 # from transitions import Machine, State
-# import threading
+import threading
 import time
 import logging
-import helpers
 import RPi.GPIO as GPIO
 
-from easysettings import EasySettings
 import datetime # fuer Alarm Class
-import locale
 import configparser
 import io
+import json
 import os
-from signal import alarm
+from collections import deque
 
 from pathlib import Path
 import shutil
 import subprocess
 
+from helpers import easing, glyphs, lightramp, profiler
+from helpers.audio import Audio, MPDError
+from helpers.display import Display
+from helpers.ledout import LED
+from helpers.recurrence import Recurrence, DAY_CHOICES
+from helpers.scheduler import AlarmScheduler
+from helpers.settingsstore import SettingsStore
+from helpers.titlecatalog import TitleCatalog
+
 #### CONSTANTS ####
 
 CONF_FILE = "/etc/lichtwecker/lichtwecker.conf"
@@ -34,8 +41,14 @@ class Config(object):
     def __init__(self):
         self._props = self._read_properties_file(CONF_FILE)
 
-    def value(self, key):
-        return self._props[key]
+    # marks keys which must be in the config file
+    REQUIRED = object()
+
+    def value(self, key, default=REQUIRED):
+        if (default is Config.REQUIRED):
+            return self._props[key]
+        # optional keys, older config files do not have them
+        return self._props.get(key, default)
 
     def _read_properties_file(self,file_path):
         with open(file_path) as f:
@@ -52,7 +65,21 @@ class Config(object):
 class Buttons(object):
     """ setting up the IO Ports for the Buttons and registering a callback, 
         when they get pressed (coupled with lichtwecker Class)
+
+        Holding up or down repeats the key, faster the longer it is held.
+        Holding one of the other buttons sends a long press once, as its
+        own key: Buttons.long(key). Both arrive as normal keypress events.
     """
+
+    # all in seconds
+    HOLD_DELAY = 0.5 # until up and down start repeating
+    REPEAT_INTERVAL = 0.25 # first repeat interval, ...
+    REPEAT_MIN_INTERVAL = 0.03 # ... getting shorter down to this
+    REPEAT_ACCELERATION = 0.85 # interval factor per repeat
+    LONG_PRESS = 1.0 # the other buttons send a long press after this
+    POLL_INTERVAL = 0.02 # checking if a held button was released
+
+    LONG_PRESS_FLAG = 0x100 # pin numbers are below
     
     def __init__(self, lichtwecker):
 
@@ -72,7 +99,13 @@ class Buttons(object):
             self.okbutton,
             ]
         
+        self.repeat_buttons = [self.upbutton, self.downbutton]
+
         if (debug): print ("Configged buttons: {}".format(self.buttons))
+
+        # buttons being watched while held, one thread each
+        self._held = set()
+        self._held_lock = threading.Lock()
         
         # register getting informed on button down events
         self.register_button_handlers()
@@ -87,6 +120,57 @@ class Buttons(object):
     def buttonpress_received(self, button):
         # forward button press to Lichtwecker Class
         self.lw.buttonpress_received(button)
+        self.watch_hold(button)
+
+    @classmethod
+    def long(cls, key):
+        """ key code of a long press of key """
+        return key | cls.LONG_PRESS_FLAG
+
+    @classmethod
+    def is_long(cls, key):
+        return (key & cls.LONG_PRESS_FLAG) != 0
+
+    def is_pressed(self, button):
+        # pulled up, pressed buttons read low
+        return GPIO.input(button) == GPIO.LOW
+
+    def watch_hold(self, button):
+        """ follow a pressed button in a thread, until it is released """
+        with self._held_lock:
+            if (button in self._held):
+                return
+            self._held.add(button)
+        threading.Thread(target=self.hold_loop, args=(button,), name="ButtonHold", daemon=True).start()
+
+    def hold_loop(self, button):
+        try:
+            if (button in self.repeat_buttons):
+                self.repeat_while_held(button)
+            elif (not self.released_within(button, self.LONG_PRESS)):
+                if (debug): print ("Long press: {0:d}".format(button))
+                self.lw.buttonpress_received(self.long(button))
+                self.released_within(button, None)
+        finally:
+            with self._held_lock:
+                self._held.discard(button)
+
+    def repeat_while_held(self, button):
+        wait = self.HOLD_DELAY
+        interval = self.REPEAT_INTERVAL
+        while (not self.released_within(button, wait)):
+            self.lw.buttonpress_received(button)
+            wait = interval
+            interval = max(self.REPEAT_MIN_INTERVAL, interval * self.REPEAT_ACCELERATION)
+
+    def released_within(self, button, seconds):
+        """ True if the button is released within seconds (None: wait for it) """
+        deadline = None if seconds is None else time.monotonic() + seconds
+        while (self.is_pressed(button)):
+            if (deadline is not None and time.monotonic() >= deadline):
+                return False
+            time.sleep(self.POLL_INTERVAL)
+        return True
 
 #### CIRCUITS EVENTS ####    
 
@@ -111,6 +195,11 @@ class keypress(Event):
     sent by Root Component to activate a Child, contains the pressed key.
     """
 
+class fade_done_event(Event):
+    """ 
+    sent by the Fader to the channel which asked for it, when all fades of a LED are done (contains the LED)
+    """
+
 #### CIRCUITS COMPONENTS ####    
 
 class Boot(Component):
@@ -122,14 +211,114 @@ class Boot(Component):
 
     BOOT_SONG = "dosem.mp3"
 
+    # a self test younger than this is not repeated on a fast boot (hours)
+    SELFTEST_MAX_AGE = 24
+
+    # how long the boot song plays in the background self test (seconds)
+    AUDIO_TEST_TIME = 10
+
     def __init__(self, lichtwecker):
         Component.__init__(self)
         self.lw = lichtwecker
         self.channel = "boot"
+        self.in_background = False
+        self.music_refresh_pending = False
+        self.refresh_thread = None
+        self.selftest_file = self.lw.config.value("selftest_cache", "selftest.json")
         
     def start_component_event(self):
         #self.timer = Timer(1, Event.create("update_boot_screen"), persist=True).register(self)
-        self.show_boot_sequence()
+        # while the playlist is still the one the positions were stored
+        # for, the boot song replaces it
+        self.lw.migrate_alarm_titles()
+        if (self.lw.config.value("fast_boot", "yes").lower() in ("yes", "true", "on", "1")):
+            self.fast_boot()
+        else:
+            self.show_boot_sequence()
+
+    def fast_boot(self):
+        """ show the clock right away, the self test (only if the last one
+            is too old) and the music refresh run in the background
+        """
+        self.lw.led.set_brightness(self.lw.led.LCD_BG, 100)
+        self.lw.lcd.lcd_string("Hallo {}".format(self.lw.config.value("owner")), self.lw.lcd.LCD_LINE_1)
+
+        self.in_background = True
+        self.fire(component_done_event(self), self.lw.channel)
+
+        if (self.selftest_is_recent()):
+            if (debug): print ("Boot: recent self test found, skipping it")
+            self.start_music_refresh()
+        else:
+            self.start_background_selftest()
+
+    def selftest_is_recent(self):
+        try:
+            with open(self.selftest_file) as f:
+                passed = json.load(f)["passed"]
+        except (OSError, ValueError, KeyError):
+            return False
+        max_age = float(self.lw.config.value("selftest_max_age_hours", self.SELFTEST_MAX_AGE)) * 3600
+        return 0 <= time.time() - passed < max_age
+
+    def remember_selftest(self):
+        try:
+            with open(self.selftest_file + ".tmp", "w") as f:
+                json.dump({"passed": time.time()}, f)
+            os.replace(self.selftest_file + ".tmp", self.selftest_file)
+        except OSError:
+            logging.warning("could not write self test result to {}".format(self.selftest_file))
+
+    def start_background_selftest(self):
+        # sound and light only, the display belongs to the clock already.
+        # The LCD backlight is left alone as well, the clock sets it.
+        try:
+            self.lw.audio.playsingle(Boot.BOOT_SONG)
+            self.audio_ok = True
+        except MPDError:
+            self.audio_ok = False
+        # the music refresh only waits for the sound, not for the LEDs:
+        # their fades are cancelled when somebody touches the light
+        if (self.audio_ok):
+            Timer(self.AUDIO_TEST_TIME, Event.create("finish_background_selftest")).register(self)
+        else:
+            self.finish_background_selftest()
+        self.leds_to_test = [led for led in self.lw.led.names.keys() if led != self.lw.led.LCD_BG]
+        self.diminandoutled(self.leds_to_test.pop(0), pause=0)
+
+    def start_music_refresh(self):
+        # MPD is slow with big USB sticks, don't let anybody wait for it
+        self.music_refresh_pending = True
+        if (self.refresh_thread is not None and self.refresh_thread.is_alive()):
+            return
+        self.refresh_thread = threading.Thread(target=self.refresh_music_in_background, name="BootRefresh", daemon=True)
+        self.refresh_thread.start()
+
+    def retry_music_refresh(self):
+        """ called when an alarm is over, it may have held up the refresh """
+        if (self.music_refresh_pending):
+            self.start_music_refresh()
+
+    def refresh_music_in_background(self):
+        if (self.lw.current_state == "alarmhandler"):
+            # refreshing clears the playlist, which would stop the alarm
+            # music. Stays pending until the alarm is over.
+            if (debug): print ("Boot: alarm running, music refresh postponed")
+            return
+        self.music_refresh_pending = False
+        started = time.monotonic()
+        if (self.lw.audio.refresh_music_dir() is None):
+            return
+        # the idle listener normally notices the end, asking also covers
+        # the times it has no connection
+        try:
+            while (self.lw.audio.rescan_progress()["running"]):
+                time.sleep(1)
+        except MPDError as error:
+            # MPD finishes the update on its own, we just don't know when
+            logging.warning("Boot: lost MPD while waiting for the music refresh: {}".format(error))
+            return
+        logging.info("Boot: music refresh took {0:.1f}s".format(time.monotonic() - started))
         
     def show_boot_sequence(self):
         
@@ -147,35 +336,90 @@ class Boot(Component):
         self.lw.lcd.lcd_string("System Test", self.lw.lcd.LCD_LINE_1)
         self.lw.lcd.lcd_string("TON!", self.lw.lcd.LCD_LINE_2)
         self.lw.audio.playsingle(Boot.BOOT_SONG)
+        self.audio_ok = True
                 
         time.sleep(3)
 
-        for led in self.lw.led.names.keys():
-            self.diminandoutled(led)
-            time.sleep(1)
+        # test the LEDs one after another, the fader tells when one is done
+        self.leds_to_test = list(self.lw.led.names.keys())
+        self.diminandoutled(self.leds_to_test.pop(0), pause=0)
+
+    def fade_done_event(self, led):
+        if (self.leds_to_test):
+            self.diminandoutled(self.leds_to_test.pop(0))
+        elif (self.in_background):
+            # the music refresh does not wait for the LEDs
+            pass
+        else:
+            self.finish_boot_sequence()
+
+    def finish_background_selftest(self):
+        if (self.lw.current_state != "alarmhandler"):
+            self.lw.audio.stop()
+        if (self.audio_ok):
+            self.remember_selftest()
+        self.start_music_refresh()
+
+    def finish_boot_sequence(self):
         
         # refresh MPD's audio Database
         self.lw.audio.stop()
         self.lw.audio.refresh_music_dir()    
         
         self.lw.lcd.lcd_string("FERTSCH!", self.lw.lcd.LCD_LINE_2)
+        self.remember_selftest()
         
         # inform lw instance, we are done
         self.fire(component_done_event(self), self.lw.channel)
 
-    def diminandoutled(self, led):
-        self.lw.lcd.lcd_string("System Test", self.lw.lcd.LCD_LINE_1)
-        self.lw.lcd.lcd_string("LED: {0:>11}".format(self.lw.led.name_for_led(led)), self.lw.lcd.LCD_LINE_2)
-        
-        for brightness in range(1,101):
-            self.lw.led.set_brightness(led, brightness)
-            time.sleep(0.01)
-        for brightness in range(100,-1, -1):
-            self.lw.led.set_brightness(led, brightness)
-            time.sleep(0.01)
+    def diminandoutled(self, led, pause=1.0):
+        if (not self.in_background):
+            self.lw.lcd.lcd_string("System Test", self.lw.lcd.LCD_LINE_1)
+            self.lw.lcd.lcd_string("LED: {0:>11}".format(self.lw.led.name_for_led(led)), self.lw.lcd.LCD_LINE_2)
+        
+        self.lw.fader.fade(led, 100, 1.0, delay=pause, notify=self.channel)
+        self.lw.fader.fade(led, 0, 1.0, queue=True, notify=self.channel)
             
         if (led == self.lw.led.LCD_BG):
-            self.lw.led.set_brightness(led, 100)
+            self.lw.fader.fade(led, 100, 0.2, queue=True, notify=self.channel)
+
+class DeadlineTimers(object):
+    """ Mixin for Components: instead of polling with a persistent Timer, 
+        arm a one-shot Timer for the moment something actually changes. 
+        Timers have a name, arming a name again replaces its timer.
+    """
+
+    def arm_deadline(self, name, when, event_name):
+        """ fire event_name at when (epoch seconds or datetime) """
+        self.disarm_deadline(name)
+        if (isinstance(when, datetime.datetime)):
+            when = time.mktime(when.timetuple()) + when.microsecond / 1e6
+        delay = max(0.0, when - time.time())
+        self._deadline_timers()[name] = Timer(delay, Event.create(event_name)).register(self)
+
+    def arm_next_second(self, name, event_name):
+        """ fire just after the next full second, so ticks follow the wall clock """
+        self.arm_deadline(name, int(time.time()) + 1 + self.DEADLINE_SLACK, event_name)
+
+    def arm_next_minute(self, name, event_name):
+        self.arm_deadline(name, (int(time.time()) // 60 + 1) * 60 + self.DEADLINE_SLACK, event_name)
+
+    def disarm_deadline(self, name):
+        timer = self._deadline_timers().pop(name, None)
+        if (timer is not None):
+            timer.unregister()
+
+    def disarm_all_deadlines(self):
+        for name in list(self._deadline_timers()):
+            self.disarm_deadline(name)
+
+    # fire a little after the boundary, never just before it
+    DEADLINE_SLACK = 0.02
+
+    def _deadline_timers(self):
+        if (not hasattr(self, "_deadlines")):
+            self._deadlines = {}
+        return self._deadlines
 
 class BaseLWComponent(Component):
     
@@ -184,6 +428,90 @@ class BaseLWComponent(Component):
         self.lw = lichtwecker
         self.channel = self.name.lower()
 
+class Fader(BaseLWComponent):
+    """ Fades LEDs without blocking: callers ask for "fade LED x to y in t
+        seconds" and return at once. One timer advances all running fades
+        together, FRAME_RATE times a second, and only runs while something
+        fades. A new fade of a LED replaces the running one and starts from
+        the current brightness, unless it is queued behind it.
+    """
+
+    FRAME_RATE = 50
+
+    def __init__(self, lichtwecker):
+        BaseLWComponent.__init__(self, lichtwecker)
+        self.timer = None
+        self.transitions = {} # led -> deque of transitions, the first one runs
+        self.notify = {} # led -> channel to send fade_done_event to
+
+    def fade(self, led, target, duration, curve="linear", delay=0, queue=False, notify=None):
+        transition = {
+            "target": float(target),
+            "duration": float(duration),
+            "curve": easing.get(curve),
+            "delay": delay,
+            "start_time": None, # set when it becomes the running one
+            "start_value": None,
+        }
+        if (queue and led in self.transitions):
+            self.transitions[led].append(transition)
+        else:
+            self.transitions[led] = deque([transition])
+            self.notify.pop(led, None)
+        if (notify is not None):
+            self.notify[led] = notify
+
+        if (self.timer is None):
+            self.timer = Timer(1.0 / self.FRAME_RATE, Event.create("fader_tick"), persist=True).register(self)
+        self.fader_tick()
+
+    def cancel(self, led=None):
+        """ stop fading (all LEDs if none given), LEDs keep their brightness """
+        for fading_led in list(self.transitions.keys()):
+            if (led is None or led == fading_led):
+                del self.transitions[fading_led]
+                self.notify.pop(fading_led, None)
+
+    def is_fading(self, led=None):
+        if (led is None):
+            return len(self.transitions) > 0
+        return led in self.transitions
+
+    def fader_tick(self, *args):
+        now = time.monotonic()
+
+        for led in list(self.transitions.keys()):
+            queue = self.transitions[led]
+            # several transitions may finish within one frame
+            while (queue):
+                transition = queue[0]
+                if (transition["start_time"] is None):
+                    transition["start_time"] = now + transition["delay"]
+                    transition["start_value"] = self.lw.led.brightness(led)
+                if (now < transition["start_time"]):
+                    break
+
+                if (transition["duration"] > 0):
+                    progress = min(1.0, (now - transition["start_time"]) / transition["duration"])
+                else:
+                    progress = 1.0
+                start = transition["start_value"]
+                value = start + (transition["target"] - start) * transition["curve"](progress)
+                self.lw.led.set_brightness(led, round(value, 1))
+
+                if (progress < 1.0):
+                    break
+                queue.popleft()
+
+            if (not queue):
+                del self.transitions[led]
+                if (led in self.notify):
+                    self.fire(fade_done_event(led), self.notify.pop(led))
+
+        if (not self.transitions and self.timer is not None):
+            self.timer.unregister()
+            self.timer = None
+
 
 class SetAlarm(BaseLWComponent):
 
@@ -205,12 +533,8 @@ class SetAlarm(BaseLWComponent):
                     {   
                         "line1":    "Tage:",
                         "store_as": "alarm_{0:d}_trigger",
-                        "min_val": 0,
-                        "max_val": 2,
                         "possible_values": [ 
-                            { "displayname": "Werktags", "value": "weekdays"},
-                            { "displayname": "Wochenende", "value": "weekend"},
-                            { "displayname": "jeden Tag", "value": "alldays"},
+                            { "displayname": displayname, "value": value} for displayname, value in DAY_CHOICES
                         ]
                     },
                     {   
@@ -229,6 +553,10 @@ class SetAlarm(BaseLWComponent):
                    ]
 
     
+    # the music picker starts in playlist order, holding the alarm button
+    # switches to the next
+    MUSIC_ORDERS = ["playlist"] + TitleCatalog.ORDERS
+
     def __init__(self, lichtwecker):
         BaseLWComponent.__init__(self, lichtwecker)
 
@@ -237,8 +565,47 @@ class SetAlarm(BaseLWComponent):
         self.alarm_num = args[0]
         self.items_pointer = 0
         self.values = self.get_saved_settings()
+        # all values of this alarm get written in one go, at the end
+        self.lw.settings.begin()
+        # the music is only loaded when its item is reached
+        self.title_order = None
+        self.title_slot = 0
         self.display_entry()
-        self.music = self.lw.audio.get_titles_info()
+
+    def load_music(self):
+        """ start in playlist order, which needs only the titles looked at,
+            with the saved title preselected
+        """
+        if (isinstance(self.values[4], int)):
+            # from the times titles were stored as position in the playlist
+            self.values[4] = self.lw.audio.uri_at(self.values[4]) or ""
+        self.set_title_order(self.MUSIC_ORDERS[0])
+
+    def set_title_order(self, name):
+        try:
+            if (name == "playlist"):
+                self.title_order = self.lw.audio.playlist_window()
+            else:
+                # sorting needs the whole playlist, the catalogue is kept by Audio
+                self.title_order = self.lw.audio.get_title_catalog().order(name)
+            self.title_slot = self.title_order.slot_of_uri(self.values[4])
+        except MPDError:
+            # shows "keine Musik"
+            self.title_order = TitleCatalog([]).order(name if name in TitleCatalog.ORDERS else "title")
+            self.title_slot = 0
+
+    def move_title(self, slot):
+        """ select the title in slot of the current order """
+        if (len(self.title_order) == 0):
+            return
+        slot = slot % len(self.title_order)
+        try:
+            # the file is stored, it stays the same when the playlist changes
+            self.values[4] = self.title_order.uri(slot)
+        except MPDError:
+            # playlist order asks MPD, stay on the previous title
+            return
+        self.title_slot = slot
         
     #def start_timer(self):
     #    self.timer = Timer(1, Event.create("blink_alarm_line"), persist=True).register(self)
@@ -253,9 +620,19 @@ class SetAlarm(BaseLWComponent):
             self.lw.lcd.lcd_string(current_item["possible_values"][self.values[self.items_pointer]]["displayname"], self.lw.lcd.LCD_LINE_2)
         elif(self.items_pointer == 4):
             # special case music
-            print ("Music: {}".format([self.values[self.items_pointer]]))
-            music_title = self.music[self.values[self.items_pointer]]["title"]
-            self.lw.lcd.lcd_string(music_title, self.lw.lcd.LCD_LINE_2) 
+            if (self.title_order is None):
+                self.load_music()
+            if (debug): print ("Music: {}".format([self.values[self.items_pointer]]))
+            self.lw.lcd.lcd_string("Musik: {0:s}".format(TitleCatalog.ORDER_NAMES[self.title_order.name]), self.lw.lcd.LCD_LINE_1)
+            try:
+                title = self.title_order.display(self.title_slot) if len(self.title_order) > 0 else None
+            except MPDError:
+                title = None
+            if (title is None):
+                self.lw.lcd.lcd_string("keine Musik", self.lw.lcd.LCD_LINE_2)
+            else:
+                # long titles scroll
+                self.lw.lcd.lcd_marquee(title, self.lw.lcd.LCD_LINE_2)
         elif("formatstring" in current_item):
             self.lw.lcd.lcd_string(current_item["formatstring"].format(self.values[self.items_pointer]), self.lw.lcd.LCD_LINE_2)
         else:
@@ -284,9 +661,7 @@ class SetAlarm(BaseLWComponent):
 
             # music
             if (self.items_pointer == 4):
-                self.values[self.items_pointer] += 1
-                if (self.values[self.items_pointer] >= len(self.music)):
-                    self.values[self.items_pointer] = 0
+                self.move_title(self.title_slot + 1)
 
             self.display_entry()
 
@@ -305,12 +680,25 @@ class SetAlarm(BaseLWComponent):
 
             # music
             if (self.items_pointer == 4):
-                self.values[self.items_pointer] -= 1
-                if (self.values[self.items_pointer] < 0):
-                    self.values[self.items_pointer] = len(self.music) - 1
+                self.move_title(self.title_slot - 1)
 
             self.display_entry()
 
+        # music: the alarm button jumps to the next letter, artist or
+        # folder, holding it switches between sorting by those
+        if (self.items_pointer == 4 and len(self.title_order) > 0):
+            if (key == self.lw.buttons.alarmbutton):
+                self.title_before_jump = self.values[4]
+                self.move_title(self.title_order.next_group(self.title_slot))
+                self.display_entry()
+
+            if (key == Buttons.long(self.lw.buttons.alarmbutton)):
+                # the press before the long press jumped, undo that
+                self.values[4] = self.title_before_jump
+                orders = self.MUSIC_ORDERS
+                self.set_title_order(orders[(orders.index(self.title_order.name) + 1) % len(orders)])
+                self.display_entry()
+
         if (key == self.lw.buttons.okbutton):
 
             self.save_single_value()
@@ -318,6 +706,7 @@ class SetAlarm(BaseLWComponent):
             self.items_pointer += 1
             if (self.items_pointer >= len (self.alarm_items)):
                 self.activate_alarm()
+                self.lw.settings.end()
                 self.fire(component_done_event(self))
             else:
                 self.display_entry()
@@ -344,6 +733,9 @@ class SetAlarm(BaseLWComponent):
 
         # mark alarm as active (Rest was saved during rest of this class
         self.lw.settings.setsave("alarm_{0:d}_enabled".format(self.alarm_num), True)
+        if (self.alarm_num > self.lw.alarm_count()):
+            # this was a new alarm
+            self.lw.settings.setsave("alarm_count", self.alarm_num)
         
         self.lw.lcd.lcd_string("Alarm {0:d}:".format(self.alarm_num), self.lw.lcd.LCD_LINE_1)
         self.lw.lcd.lcd_string("gespeichert!", self.lw.lcd.LCD_LINE_2)
@@ -379,6 +771,9 @@ class SetAlarm(BaseLWComponent):
         return values
 
 class RereadUsb(BaseLWComponent):
+
+    PROGRESS_INTERVAL = 1 # seconds between progress updates
+    DONE_DISPLAY_TIME = 3 # seconds the result stays on the display
     
     def __init__(self, lichtwecker):
         BaseLWComponent.__init__(self, lichtwecker)
@@ -386,6 +781,8 @@ class RereadUsb(BaseLWComponent):
     def start_component_event(self):
         self.display_reread_usb()
         self.counter = 0
+        self.scanning = False
+        self.done = False
         self.timer = Timer(1, Event.create("blink"), persist=True).register(self)
 
     def blink(self):
@@ -402,22 +799,59 @@ class RereadUsb(BaseLWComponent):
             self.lw.lcd.lcd_string("Start", self.lw.lcd.LCD_LINE_2)
         
     def keypress(self, key):
+
+        if (self.lw.buttons.is_long(key)):
+            return
+
+        if (self.done):
+            # any key skips the result
+            self.timer.unregister()
+            self.finish()
+            return
         
-        self.timer.unregister()
-            
         if (key == self.lw.buttons.menubutton):
-            self.lw.lcd.lcd_string("abgebrochen", self.lw.lcd.LCD_LINE_2)
+            self.timer.unregister()
+            if (self.scanning):
+                # MPD goes on, the playlist is rebuilt when it is done
+                self.lw.lcd.lcd_string("laeuft weiter", self.lw.lcd.LCD_LINE_2)
+            else:
+                self.lw.lcd.lcd_string("abgebrochen", self.lw.lcd.LCD_LINE_2)
             self.fire(component_done_event(self))
             
-        if (key == self.lw.buttons.okbutton):
+        if (key == self.lw.buttons.okbutton and not self.scanning):
+            self.timer.unregister()
             self.lw.lcd.lcd_string("gestartet...", self.lw.lcd.LCD_LINE_2)
-            self.lw.audio.refresh_music_dir()
-            if (debug): print ("Titel: {}".format(self.lw.audio.get_titles_info()))
-            titlelist = self.lw.audio.get_titles_info()
-            titlecount = len (titlelist)
-            self.lw.lcd.lcd_string("gefunden: {0:d}".format(titlecount), self.lw.lcd.LCD_LINE_2)
-            time.sleep(3)
-            self.lw.lcd.lcd_string("fertig", self.lw.lcd.LCD_LINE_2)
+            self.lw.migrate_alarm_titles()
+            if (self.lw.audio.refresh_music_dir() is None):
+                self.show_done("MPD Fehler")
+                return
+            self.scanning = True
+            self.timer = Timer(self.PROGRESS_INTERVAL, Event.create("show_progress"), persist=True).register(self)
+
+    def show_progress(self):
+        try:
+            progress = self.lw.audio.rescan_progress()
+        except MPDError:
+            self.timer.unregister()
+            self.show_done("MPD Fehler")
+            return
+
+        if (progress["running"]):
+            self.lw.lcd.lcd_string("{0:d} Titel {1:d}s".format(progress["songs"], int(progress["elapsed"])), self.lw.lcd.LCD_LINE_2)
+        else:
+            self.timer.unregister()
+            if (debug): print ("Rescan done: {}".format(progress))
+            self.show_done("gefunden: {0:d}".format(progress["songs"]))
+
+    def show_done(self, text):
+        self.scanning = False
+        self.done = True
+        self.lw.lcd.lcd_string(text, self.lw.lcd.LCD_LINE_2)
+        self.timer = Timer(self.DONE_DISPLAY_TIME, Event.create("finish")).register(self)
+
+    def finish(self):
+        if (self.done):
+            self.done = False
             self.fire(component_done_event(self))
 
 class SetSnooze(BaseLWComponent):
@@ -438,14 +872,18 @@ class SetSnooze(BaseLWComponent):
     def blink_snooze_line(self):
         pair = self.counter % 2 == 0
 
+        # only the number blinks, so just rewrite its two columns
         if pair:
-            self.lw.lcd.lcd_string("   min", self.lw.lcd.LCD_LINE_2)
+            self.lw.lcd.lcd_write("  ", self.lw.lcd.LCD_LINE_2, 0)
         else:
-            self.lw.lcd.lcd_string("{0:2d} min".format(self.snooze), self.lw.lcd.LCD_LINE_2)
+            self.lw.lcd.lcd_write("{0:2d}".format(self.snooze), self.lw.lcd.LCD_LINE_2, 0)
     
         self.counter += 1
 
     def keypress(self, key):
+
+        if (self.lw.buttons.is_long(key)):
+            return
         
         self.timer.unregister()
         
@@ -547,17 +985,8 @@ class Menu(Component):
     """ This Component handles the menu, which gets 
         displayed when the Menu button is pressed
     """
+    # the "Alarm n setzen" entries are put in front of these in build_menu_items
     menu_items = [  
-                    {   
-                        "display":      "Alarm 1 setzen",
-                        "component":    "SetAlarm",
-                        "params":       1
-                    },
-                    {   
-                        "display":      "Alarm 2 setzen",
-                        "component":    "SetAlarm",
-                        "params":       2
-                    },
                     {   
                         "display":      "Schlummerzeit",
                         "component":    "SetSnooze",
@@ -588,8 +1017,26 @@ class Menu(Component):
     def start_component_event(self):
         # init menu pointer
         if (debug): print ("Menu Start received")
+        self.menu_items = self.build_menu_items()
         self.current_entry = 0
         self.display_menu()
+
+    def build_menu_items(self):
+        alarm_count = self.lw.alarm_count()
+        items = []
+        for alarm_num in range(1, alarm_count + 1):
+            items.append({
+                "display":      "Alarm {0:d} setzen".format(alarm_num),
+                "component":    "SetAlarm",
+                "params":       alarm_num
+            })
+        if (alarm_count < LichtWecker.MAX_ALARMS):
+            items.append({
+                "display":      "Neuer Alarm",
+                "component":    "SetAlarm",
+                "params":       alarm_count + 1
+            })
+        return items + Menu.menu_items
         
     def display_menu(self):
         self.lw.lcd.lcd_string("Einstellungen <>", self.lw.lcd.LCD_LINE_1)
@@ -613,9 +1060,11 @@ class Menu(Component):
             self.lw.lcd.lcd_string("gehe zurueck...", self.lw.lcd.LCD_LINE_2)
             self.fire(component_done_event(self, self.current_entry))
 
-class Clock(Component):
+class Clock(DeadlineTimers, Component):
     """ the clock component, it displays time, alarm time and checks if an alarm is due"""
 
+    LIGHT_FADE_DURATION = 1.5 # seconds to switch the reading light on or off
+
     def __init__(self, lichtwecker):
         
         Component.__init__(self)
@@ -627,35 +1076,55 @@ class Clock(Component):
         self.alarms = 0
         self.lightison = False
         self.alarm_in_progress_time = None
+        self._next_alarm = None # cached NextAlarm
+        self._alarms_before_off = 0
+        # all enabled alarms, ordered by their next fire time
+        self.scheduler = AlarmScheduler()
+
+        # the settings tell us about changes, no need to read them every time
+        self._alarms_changed = True
+        self.lcd_brightness = self.lw.settings.get("lcd_brightness")
+        self.lw.settings.subscribe("alarm_", self.alarm_settings_changed)
+        self.lw.settings.subscribe("lcd_brightness", self.lcd_brightness_changed)
         
     def start_component_event(self, *args):
         if (debug): print ("Clock start event received")
-        self.timer = Timer(1, Event.create("update_clock_screen"), persist=True).register(self)
-
-        # retrieve, if alarms are enabled (Alarm 1 and to get OR'ed together       
-        if self.lw.settings.has_option('alarm_1_enabled'):
-            if(self.lw.settings.get("alarm_1_enabled")):
-                self.alarms = self.alarms | 1
-        else: 
-            self.alarms = self.alarms & 2
-                
-        if self.lw.settings.has_option('alarm_2_enabled'):
-            if(self.lw.settings.get("alarm_2_enabled")):
-                self.alarms = self.alarms | 2
-        else: 
-            self.alarms = self.alarms & 1
 
-        # get LCD Brightness from Setting
-        self.lcd_brightness = self.lw.settings.get("lcd_brightness")
+        # alarm settings may have been changed, while we were away
+        if (self._alarms_changed):
+            self._alarms_changed = False
+
+            # retrieve, which alarms are enabled (alarm n is bit n-1 of self.alarms)
+            self.alarms = 0
+            for alarm_num in range(1, self.lw.alarm_count() + 1):
+                if (self.lw.settings.alarm(alarm_num).enabled):
+                    self.alarms = self.alarms | self.alarm_bit(alarm_num)
+            self.schedule_alarms()
+
+        # leaving the clock (menu, alarm) disarmed the alarm deadline
+        self.invalidate_next_alarm()
+        self.arm_alarm_deadline(self.get_next_alarm())
+
+        self.update_clock_screen()
+
+        # the boot self test may have changed the LCD background
         self.lw.led.set_brightness(self.lw.led.LCD_BG, self.lcd_brightness)
 
+    def alarm_settings_changed(self, option, value):
+        """ any alarm_... setting changed, the scheduler is rebuilt on the next start """
+        self._alarms_changed = True
+
+    def lcd_brightness_changed(self, option, value):
+        self.lcd_brightness = value
+        self.lw.led.set_brightness(self.lw.led.LCD_BG, value)
+
     def keypress(self, key, *args):
 
         if (debug): print ("Keypress in Clock: {}".format(key))
 
         if (key == self.lw.buttons.menubutton):
             if (debug): print ("MenuButton Pressed")
-            self.timer.unregister()
+            self.disarm_all_deadlines()
             self.fire(component_done_event(self, "menu"))
         
         if (key == self.lw.buttons.downbutton):
@@ -668,11 +1137,9 @@ class Clock(Component):
             self.setlight(not self.lightison) 
             
         if (key == self.lw.buttons.alarmbutton):
-            # mark alarm as active (Rest was saved during rest of this class
-            self.alarms +=1
-            if (self.alarms > 3):
-                self.alarms = 0
+            self.toggle_alarms()
             self.write_alarms()
+            self.schedule_alarms()
             self.update_clock_screen()
     
     def update_clock_screen(self, *args):
@@ -686,79 +1153,155 @@ class Clock(Component):
 
         self.lw.lcd.lcd_string(datetimestring, self.lw.lcd.LCD_LINE_1)
         
-        if (self.alarms == 3):
-            alarms_active_string = "A1,A2"
-        elif (self.alarms == 1):
-            alarms_active_string = "A1"
-        elif (self.alarms == 2):
-            alarms_active_string = "A2"
-        else: 
-            alarms_active_string = ""
+        alarms_active_string = self.get_alarms_active_string()
 
-        alarm1 = Alarm.from_settings(1, self.lw.settings)
-        alarm2 = Alarm.from_settings(2, self.lw.settings)
+        next_alarm = self.get_next_alarm()
         
-        print ("Active Alarms:{}".format(self.alarms))
-        
-        if (debug): print ("Alarm1: {}".format(alarm1))
-        if (debug): print ("Alarm2: {}".format(alarm2))
-        
-        if (self.alarms == 3):
-            if (alarm1 < alarm2):
-                self.next_alarm = alarm1
-            else:
-                self.next_alarm = alarm2
-        
-        elif (self.alarms == 2):
-            self.next_alarm = alarm2
-        elif (self.alarms == 1):
-            self.next_alarm = alarm1
-        else:
+        if (next_alarm is None):
             self.next_alarm = None
-        
-        print ("Self next alarm = {}".format(self.next_alarm))
-        
-        if (self.next_alarm is None):
             nextwaketime = ""
         else:    
-            nextwaketime = self.next_alarm.get_time_as_string()
+            self.next_alarm = next_alarm.alarm
+            nextwaketime = next_alarm.time_string
         
         self.lw.lcd.lcd_string("{0:<5s}{1:>11s}".format(alarms_active_string, nextwaketime), self.lw.lcd.LCD_LINE_2)
 
+        if (self.counter == 0):
+            self.lw.log_first_clock_frame()
+
         self.counter += 1
-        
-        alarm_mins = self.next_alarm.alarm_in_minutes()
-        
-        if (debug): print ("Alarm in minutes: {0:d}".format(alarm_mins))
-        if (debug): print ("Alarm with lights: {}".format(self.next_alarm.with_light))
-        
-        
-        
-        if (self.next_alarm.with_light == "on"):
-            if (alarm_mins <=30):
-                self.start_alarmhandler(self.next_alarm)
+
+        # the colon blinks, so the next change is at the next full second
+        self.arm_next_second("tick", "update_clock_screen")
+
+    def arm_alarm_deadline(self, next_alarm):
+        """ wake up exactly when the next alarm has to be started """
+        if (next_alarm is None):
+            self.disarm_deadline("alarm")
         else:
-            if (alarm_mins <=0):
-                self.start_alarmhandler(self.next_alarm)
-                
+            self.arm_deadline("alarm", self.alarm_start_time(next_alarm), "check_alarm")
+
+    def alarm_start_time(self, next_alarm):
+        # alarms with light start early, for the sunrise
+        if (next_alarm.alarm.with_light == "on"):
+            return next_alarm.fire_time - datetime.timedelta(minutes=self.lw.ramp_minutes)
+        return next_alarm.fire_time
+
+    def check_alarm(self, *args):
+        next_alarm = self.get_next_alarm()
+        if (next_alarm is None):
+            return
+
+        if (datetime.datetime.now() < self.alarm_start_time(next_alarm)):
+            # timer was early
+            self.arm_alarm_deadline(next_alarm)
+        elif (not self.start_alarmhandler(next_alarm.alarm, next_alarm.fire_time)):
+            # handled already (stopped early), look again once it is over
+            self.arm_deadline("alarm", next_alarm.fire_time + datetime.timedelta(seconds=1), "check_alarm")
+
+    def invalidate_next_alarm(self):
+        """ forget the cached next alarm, it gets recomputed on the next tick """
+        self._next_alarm = None
+
+    def alarm_bit(self, alarm_num):
+        return 1 << (alarm_num - 1)
+
+    def toggle_alarms(self):
+        """ alarm button: with up to two alarms cycle through all combinations,
+            with more switch all off and back to what was enabled before
+        """
+        alarm_count = self.lw.alarm_count()
+        if (alarm_count <= 2):
+            self.alarms += 1
+            if (self.alarms >= (1 << alarm_count)):
+                self.alarms = 0
+        elif (self.alarms != 0):
+            self._alarms_before_off = self.alarms
+            self.alarms = 0
+        else:
+            self.alarms = self._alarms_before_off or (1 << alarm_count) - 1
+
+    def get_alarms_active_string(self):
+        active = [alarm_num for alarm_num in range(1, self.lw.alarm_count() + 1) if self.alarms & self.alarm_bit(alarm_num)]
+        if (not active):
+            return ""
+        text = glyphs.BELL + ",".join("{0:d}".format(alarm_num) for alarm_num in active)
+        if (len(text) > 5):
+            # does not fit, just tell how many
+            text = "{0:d}x{1:s}".format(len(active), glyphs.BELL)
+        return text
+
+    def schedule_alarms(self):
+        """ (re)build the scheduler from the settings, only enabled alarms """
+        now = datetime.datetime.now()
+        self.scheduler.clear()
+        for alarm_num in range(1, self.lw.alarm_count() + 1):
+            if (self.alarms & self.alarm_bit(alarm_num)):
+                try:
+                    alarm = Alarm.from_settings(alarm_num, self.lw.settings)
+                except ValueError as error:
+                    # a broken trigger or date only costs this one alarm
+                    logging.error("alarm {0:d} skipped: {1}".format(alarm_num, error))
+                    continue
+                fire_time = alarm.alarmtime(now)
+                if (fire_time is not None):
+                    self.scheduler.schedule(alarm_num, fire_time, alarm)
+        self.invalidate_next_alarm()
+        self.get_next_alarm()
+
+    def get_next_alarm(self):
+        """ the next alarm as NextAlarm (or None if no alarm is active).
+            It is only recomputed when the alarms changed or the cached
+            result ran out of date, every other tick just compares times.
+            Recomputing also re-arms the deadline timer starting the alarm.
+        """
+        now = datetime.datetime.now()
+        cached = self._next_alarm
+        if (cached is not None and now < cached.valid_until):
+            return cached
+
+        # alarms which fired are moved to their next occurrence
+        top = self.scheduler.peek()
+        while (top is not None and top[0] <= now):
+            fire_time, alarm_num, alarm = top
+            if (fire_time != self.alarm_in_progress_time and now < fire_time + datetime.timedelta(minutes=AlarmHandler.MAX_ALARM_TIME_IN_MINUTES)):
+                # passed while nobody was looking (e.g. in the menu), it
+                # stays the next alarm until check_alarm started it
+                break
+            # alarmtime(now) is now itself if now is exactly hh:mm:00,
+            # which would never leave this loop
+            fire_time = alarm.alarmtime(max(now, fire_time) + datetime.timedelta(seconds=1))
+            if (fire_time is None):
+                # last one off date passed, nothing left to ring
+                self.scheduler.remove(alarm_num)
+            else:
+                self.scheduler.schedule(alarm_num, fire_time, alarm)
+            top = self.scheduler.peek()
+
+        if (top is None):
+            self._next_alarm = None
+        else:
+            fire_time, alarm_num, alarm = top
+            self._next_alarm = NextAlarm(alarm, fire_time, now)
+            if (debug): print ("Next alarm recomputed: {0} at {1}".format(alarm, fire_time))
+
+        self.arm_alarm_deadline(self._next_alarm)
+        return self._next_alarm
         
-    def start_alarmhandler(self, alarm):
+    def start_alarmhandler(self, alarm, fire_time):
+        """ returns False if this alarm was handled already """
 
         if (debug): print ("start AlarmHandler")
         
-        if (self.alarm_in_progress_time is None):
-            # no alarm was triggered ever, so trigger this one
-            self.alarm_in_progress_time = alarm.alarmtime()
-            self.timer.unregister()
-            self.fire(component_done_event(self, "alarmhandler", alarm))
-        elif(self.alarm_in_progress_time == alarm.alarmtime()):
+        if (self.alarm_in_progress_time == fire_time):
             # This alarm was handled already, skip it
-            return
-        else:
-            # other alarm was triggered in past, but not this one, so trigger this one
-            self.alarm_in_progress_time = alarm.alarmtime()
-            self.timer.unregister()
-            self.fire(component_done_event(self, "alarmhandler", alarm))
+            return False
+
+        # no alarm or another one was triggered in past, so trigger this one
+        self.alarm_in_progress_time = fire_time
+        self.disarm_all_deadlines()
+        self.fire(component_done_event(self, "alarmhandler", alarm, fire_time))
+        return True
             
     def setlight(self, to_state):
         
@@ -767,9 +1310,9 @@ class Clock(Component):
         else:
             newVal = 0
 
-        self.lw.led.set_brightness(self.lw.led.RED, 0)
-        self.lw.led.set_brightness(self.lw.led.GREEN, 0)
-        self.lw.led.set_brightness(self.lw.led.WARM_WHITE, newVal)
+        self.lw.fader.fade(self.lw.led.RED, 0, self.LIGHT_FADE_DURATION)
+        self.lw.fader.fade(self.lw.led.GREEN, 0, self.LIGHT_FADE_DURATION)
+        self.lw.fader.fade(self.lw.led.WARM_WHITE, newVal, self.LIGHT_FADE_DURATION, curve="log")
         
         self.lightison = to_state
 
@@ -783,7 +1326,7 @@ class Clock(Component):
         if (self.lcd_brightness < 0):
             self.lcd_brightness = 0
 
-        self.lw.led.set_brightness(self.lw.led.LCD_BG, self.lcd_brightness)
+        # lcd_brightness_changed sets the LED
         self.lw.settings.setsave ("lcd_brightness", self.lcd_brightness)
         
         if (debug): print ("changed LCD brightness to {0:d}".format(self.lcd_brightness))
@@ -791,82 +1334,38 @@ class Clock(Component):
     ##### ALARM FUNCTIONS #####
 
     def write_alarms(self):
-        if (self.alarms & 2):
-            # mark alarm as active (Rest was saved during rest of this class
-            self.lw.settings.setsave("alarm_2_enabled", True)
-        else:
-            self.lw.settings.setsave("alarm_2_enabled", False)
-        
-        if (self.alarms & 1):
-            # mark alarm as active (Rest was saved during rest of this class
-            self.lw.settings.setsave("alarm_1_enabled", True)
-        else:
-            self.lw.settings.setsave("alarm_1_enabled", False)
+        for alarm_num in range(1, self.lw.alarm_count() + 1):
+            enabled = (self.alarms & self.alarm_bit(alarm_num)) != 0
+            self.lw.settings.setsave("alarm_{0:d}_enabled".format(alarm_num), enabled)
+        # self.alarms is up to date and schedule_alarms follows
+        self._alarms_changed = False
 
-    def get_next_alarm_time_as_string(self):
-        
-        # no alarm active, so no time
-        if (self.alarms == 0):
-            return ""
-        
-        if (self.alarms == 3):
-            # both alarms are active, so we need to figure, which one is closer
-            alarm1 = Alarm.retrieve_alarm_from_settings(1, self.lw.settings)
-            alarm2 = Alarm.retrieve_alarm_from_settings(2, self.lw.settings)
-            if (alarm1 < alarm2):
-                alarm_to_display = alarm1
-            else: 
-                alarm_to_display = alarm2
-        else:
-            alarm_to_display = Alarm.retrieve_alarm_from_settings(self.alarms, self.lw.settings)
-        
-
-class AlarmHandler(BaseLWComponent):
+class AlarmHandler(DeadlineTimers, BaseLWComponent):
     
-    # re-check interval in seconds (once per minute)
-    TIMER_INTERVAL = 2  
     # 
     MAX_ALARM_TIME_IN_MINUTES = 60
 
-    DISPLAY_REFRESH_INTERVAL = 30 # display refresh rate in seconds
+    # light starts this long before the alarm (sunrise), default for the
+    # ramp_minutes config key
+    RAMP_MINUTES = 30
+
+    # music starts quiet and gets louder (volume, seconds)
+    AUDIO_FADE_START_VOLUME = 10
+    AUDIO_FADE_DURATION = 60
+    AUDIO_RETRY_INTERVAL = 10 # seconds, when MPD could not start the music
     
-    light_over_time = [ 
-            { "red": 1,  "green": 0, "white": 0 },  # minute 1
-            { "red": 3,  "green": 0, "white": 0 },  # minute 2
-            { "red": 5,  "green": 0, "white": 0 },  # minute ...
-            { "red": 10,  "green": 1, "white": 0 },
-            { "red": 15,  "green": 2, "white": 0 },
-            { "red": 20,  "green": 4, "white": 0 },
-            { "red": 25,  "green": 7, "white": 0 },
-            { "red": 30,  "green": 10, "white": 0 },
-            { "red": 40,  "green": 14, "white": 0 },
-            { "red": 50,  "green": 18, "white": 0 }, # minute 10
-            { "red": 50,  "green": 23, "white": 0 },
-            { "red": 60,  "green": 30, "white": 0 },
-            { "red": 60,  "green": 40, "white": 0 },
-            { "red": 70,  "green": 80, "white": 0 },
-            { "red": 70,  "green": 80, "white": 1 },
-            { "red": 70,  "green": 80, "white": 2 },
-            { "red": 70,  "green": 80, "white": 3 },
-            { "red": 70,  "green": 80, "white": 5 },
-            { "red": 70,  "green": 80, "white": 7 },
-            { "red": 70,  "green": 80, "white": 10 }, # minute 20
-            { "red": 70,  "green": 80, "white": 14 },
-            { "red": 70,  "green": 80, "white": 18 },
-            { "red": 70,  "green": 80, "white": 24 },
-            { "red": 70,  "green": 80, "white": 30 },
-            { "red": 70,  "green": 80, "white": 38 },
-            { "red": 70,  "green": 80, "white": 48 },
-            { "red": 70,  "green": 80, "white": 60 },
-            { "red": 70,  "green": 80, "white": 74 },
-            { "red": 70,  "green": 80, "white": 86 },
-            { "red": 70,  "green": 80, "white": 100 }, # minute 30
-        ]
+    # sunrise before the alarm, compiled into a lookup table per alarm
+    RAMP_PROFILE = lightramp.SUNRISE
+    RAMP_RESOLUTION = 1.0 # seconds per step of the light ramp
     
     def __init__(self, lichtwecker):
         BaseLWComponent.__init__(self, lichtwecker)
         self.active = False
         self.alarm = None # will hold the Alarm Object
+        self.ramp = None # CompiledRamp of the light
+
+        self.snooze_minutes = self.lw.settings.get("snooze")
+        self.lw.settings.subscribe("snooze", self.snooze_setting_changed)
         
     def start_component_event(self, *args):
         """ start the Alarm Handler
@@ -884,8 +1383,12 @@ class AlarmHandler(BaseLWComponent):
     
         if (debug): print ("received alarm at start: {}".format(self.alarm))
     
-        # remember the alarm time (so we still know it, when its in the past)
-        self.alarmtime = self.alarm.alarmtime()
+        # remember the alarm time (so we still know it, when its in the past),
+        # Clock sends it along, it may have passed already when we start late
+        if (len(args) > 1):
+            self.alarmtime = args[1]
+        else:
+            self.alarmtime = self.alarm.alarmtime()
         
         # Reset snooze
         self.snoozeuntil = None
@@ -893,13 +1396,17 @@ class AlarmHandler(BaseLWComponent):
         # Reset audio flag
         self.audioplays = False
 
+        self.ramp = self.RAMP_PROFILE.compile(self.lw.ramp_minutes * 60, self.RAMP_RESOLUTION)
+
+        # the ramp controls the light from now on
+        self.lw.fader.cancel()
+
         if (debug): self.debug_in_minutes = None
 
-        # set a timer to allow for the ramp up of lighting and starting music
-        self.alarmtimer = Timer(self.TIMER_INTERVAL, Event.create("update_alarm_handler"), persist=True).register(self)
-        self.displaytimer = Timer(self.DISPLAY_REFRESH_INTERVAL, Event.create("update_display"), persist=True).register(self)
+        self.active = True
         
-        # call handler once on start manually
+        # call handler once on start manually, they arm their own timers
+        # for the next moment something changes
         self.update_alarm_handler()
         self.update_display()
             
@@ -917,6 +1424,9 @@ class AlarmHandler(BaseLWComponent):
         if (key == self.lw.buttons.alarmbutton):
             # mark alarm as active (Rest was saved during rest of this class
             self.cleanupandend()
+
+    def snooze_setting_changed(self, option, value):
+        self.snooze_minutes = value
             
     def snooze(self):
 
@@ -927,13 +1437,13 @@ class AlarmHandler(BaseLWComponent):
         self.lightsoff()
 
         # Add snooze interval to current time and store it 
-        self.snoozeuntil = datetime.datetime.now() + datetime.timedelta(minutes=self.lw.settings.get("snooze"))
+        self.snoozeuntil = datetime.datetime.now() + datetime.timedelta(minutes=self.snooze_minutes)
+        self.arm_deadline("alarm", self.snoozeuntil, "update_alarm_handler")
 
     def cleanupandend(self):
         
         # Dereg Timers
-        self.alarmtimer.unregister()
-        self.displaytimer.unregister()
+        self.disarm_all_deadlines()
 
         # stop playing audio
         self.stopaudio()
@@ -955,18 +1465,30 @@ class AlarmHandler(BaseLWComponent):
         
         alarm_in_mins = self.alarm_in_minutes()
         
+        alarm_in_secs = self.alarm_in_seconds()
         if (alarm_in_mins <= 0):
             secondline_text = "ALARM, steh auf!"
+        elif (self.alarm.with_light == "on" and alarm_in_secs <= self.ramp.duration):
+            # how far the sunrise is
+            progress = 1.0 - alarm_in_secs / self.ramp.duration
+            secondline_text = "{0:2d} min {1:s}".format(alarm_in_mins, glyphs.progress_bar(progress, 9))
         else:
             secondline_text = "ALARM in {0:d} min".format(alarm_in_mins)
             
         self.lw.lcd.lcd_string(secondline_text, self.lw.lcd.LCD_LINE_2)
+
+        # the text changes with the clock's minute, and with the minutes left
+        # until the alarm, which need not be in step with the clock
+        next_change = (int(time.time()) // 60 + 1) * 60
+        if (alarm_in_secs > 0):
+            next_change = min(next_change, time.time() + self.seconds_to_next_minute_step(alarm_in_secs))
+        self.arm_deadline("display", next_change + self.DEADLINE_SLACK, "update_display")
    
     def update_alarm_handler(self, *args):
         """ 
         Controls light and Music
         """
-        alarm_in_minutes = self.alarm_in_minutes()
+        alarm_in_secs = self.alarm_in_seconds()
         
         #TODO: Comment out section for production
         # Fast forward alarm to debug, comment out for production mode
@@ -975,7 +1497,7 @@ class AlarmHandler(BaseLWComponent):
         #alarm_in_minutes = self.debug_in_minutes
         
         
-        if (alarm_in_minutes <= 0):
+        if (alarm_in_secs <= 0):
 
             if (self.snoozeuntil != None):
                 # see if snooze time is over
@@ -989,30 +1511,46 @@ class AlarmHandler(BaseLWComponent):
                 # It's time to make Alarm!
                 
                 # Full LIGHTING
-                self.lw.led.set_brightness(self.lw.led.RED, 0)
-                self.lw.led.set_brightness(self.lw.led.GREEN, 0)
-                self.lw.led.set_brightness(self.lw.led.WARM_WHITE, 100)
+                self.set_light((0, 0, 100))
                 
                 # Play audio (if not playing already)
                 if (self.audioplays == False):
                     self.startaudio()
+            else:
+                # nothing to do until the snooze is over
+                self.arm_deadline("alarm", self.snoozeuntil, "update_alarm_handler")
                         
-        elif (alarm_in_minutes > 0 & alarm_in_minutes < 31):
+        elif (alarm_in_secs <= self.ramp.duration):
             
             # Light waking should happen
-            
-            self.lw.led.set_brightness(self.lw.led.RED, self.light_over_time[30-alarm_in_minutes]["red"])
-            self.lw.led.set_brightness(self.lw.led.GREEN, self.light_over_time[30-alarm_in_minutes]["green"])
-            self.lw.led.set_brightness(self.lw.led.WARM_WHITE, self.light_over_time[30-alarm_in_minutes]["white"])
+            elapsed = self.ramp.duration - alarm_in_secs
+            self.set_light(self.ramp.values(self.ramp.step_at(elapsed)))
+
+            # wake up again when the light changes next, or to ring
+            next_change = self.ramp.seconds_until_change(elapsed)
+            if (next_change is None):
+                next_change = alarm_in_secs
+            self.arm_deadline("alarm", time.time() + next_change + self.DEADLINE_SLACK, "update_alarm_handler")
             
         else:
             # just in case (should not happen)
             self.lightsoff()
+            self.arm_deadline("alarm", self.alarmtime - datetime.timedelta(seconds=self.ramp.duration), "update_alarm_handler")
             
         
     def startaudio(self):
-        music = self.lw.audio.get_titles_info()
-        self.lw.audio.playid(music[self.alarm.title_number]["id"])
+        title = self.alarm.title
+        if (isinstance(title, int)):
+            # not migrated yet, still the position in the playlist
+            title = self.lw.audio.uri_at(title)
+        try:
+            self.lw.audio.play_uri(title, fallback=self.lw.config.value("default_title", None), volume=self.AUDIO_FADE_START_VOLUME)
+            self.lw.audio.fade_volume(self.AUDIO_FADE_START_VOLUME, self.lw.audio.volume, self.AUDIO_FADE_DURATION)
+        except MPDError as error:
+            logging.error("alarm music could not be started: {}".format(error))
+            # try again in a while, the light keeps ringing meanwhile
+            self.arm_deadline("alarm", time.time() + self.AUDIO_RETRY_INTERVAL, "update_alarm_handler")
+            return
         self.audioplays = True
             
     def stopaudio(self):
@@ -1020,39 +1558,52 @@ class AlarmHandler(BaseLWComponent):
         self.audioplays = False
            
     def lightsoff(self):
-        self.lw.led.set_brightness(self.lw.led.RED, 0)
-        self.lw.led.set_brightness(self.lw.led.GREEN, 0)
-        self.lw.led.set_brightness(self.lw.led.WARM_WHITE, 0)
+        self.set_light((0, 0, 0))
+
+    def set_light(self, light):
+        """ set (red, green, white), LED skips channels which do not change """
+        red, green, white = light
+        self.lw.led.set_rgbw(red=red, green=green, warm_white=white)
     
     def alarm_in_minutes(self):
 
         # calc time until alarm in minutes
-        alarmdelta = self.alarmtime - datetime.datetime.now()
-        alarm_in_mins = int(alarmdelta.total_seconds()/60)
+        alarm_in_mins = int(self.alarm_in_seconds()/60)
 
         return alarm_in_mins
 
+    def alarm_in_seconds(self):
+        alarmdelta = self.alarmtime - datetime.datetime.now()
+        return alarmdelta.total_seconds()
+
+    def seconds_to_next_minute_step(self, alarm_in_secs):
+        """ time until the whole minutes left until the alarm change """
+        return (alarm_in_secs % 60) or 60
+
 class Alarm(object):
 
         @classmethod
         def from_settings(cls, alarm_num, settings):
             
-            minutes = settings.get("alarm_{0:d}_minutes".format(alarm_num))
-            hours = settings.get("alarm_{0:d}_hours".format(alarm_num))
-            trigger = settings.get("alarm_{0:d}_trigger".format(alarm_num))
-            title = settings.get("alarm_{0:d}_title".format(alarm_num))
-            with_light = settings.get("alarm_{0:d}_with_light".format(alarm_num))
-            is_active = settings.get("alarm_{0:d}_enabled".format(alarm_num))
+            # typed record, kept by the settings until the alarm is changed
+            record = settings.alarm(alarm_num)
+            is_active = record.enabled
+            # once and skip are optional extra and skipped dates, stored as "YYYY-MM-DD" strings
             
-            return Alarm(alarm_hour= hours, alarm_minutes=minutes , alarmtrigger = trigger, with_light = with_light, title_number= title, is_active=("on" is is_active))
+            return Alarm(alarm_hour= record.hours, alarm_minutes=record.minutes , alarmtrigger = record.trigger, with_light = record.with_light, title = record.title, is_active=("on" is is_active), once=record.once, skip=record.skip)
     
-        def __init__(self, alarm_hour, alarm_minutes, alarmtrigger = "weekdays", with_light = True, title_number = 0, is_active = True):
+        def __init__(self, alarm_hour, alarm_minutes, alarmtrigger = "weekdays", with_light = True, title = "", is_active = True, once = (), skip = ()):
             
             self.alarmtrigger = alarmtrigger
+            self.recurrence = Recurrence.from_trigger(
+                alarmtrigger, 
+                once=[Alarm.parse_date(date) for date in once], 
+                skip=[Alarm.parse_date(date) for date in skip],
+                )
             self.alarm_hour = alarm_hour
             self.alarm_minutes = alarm_minutes
             self.with_light = with_light
-            self.title_number = title_number
+            self.title = title # file uri of the music
             self.is_active = is_active
             
         def __lt__(self, other_alarm):
@@ -1063,37 +1614,26 @@ class Alarm(object):
                 return False
             
         def __str__(self):
-            return ("Alarm: TIME: {0:02d}:{1:02d}, trigger={2:s}".format(self.alarm_hour, self.alarm_minutes, self.alarmtrigger))
+            return ("Alarm: TIME: {0:02d}:{1:02d}, trigger={2}".format(self.alarm_hour, self.alarm_minutes, self.alarmtrigger))
             
-        def alarmtime(self):
-            now = datetime.datetime.now()
-            alarm_time = datetime.datetime(now.year, now.month, now.day, self.alarm_hour, self.alarm_minutes)
-
-            
-            if (now > alarm_time):
-                alarm_time = alarm_time + datetime.timedelta(days=1)
-
-            
-            alarm_time = self.add_days_based_on_trigger(alarm_time)
-
-            print ("Alarm_time in alarmtime func: {}".format(alarm_time))
-
-            return alarm_time
-
-        def get_time_as_string(self):
-            now = datetime.datetime.now()
-            
-            print ("alarm in time as string {}".format(self))
-            print ("now: {}".format(now))
-            print ("alartime: {}".format(self.alarmtime()))
-            delta = self.alarmtime() - now
-            
-            print ("Delta: {}".format(delta.days))  
+        def alarmtime(self, now=None):
+            """ the next time this alarm rings, None if it never does """
+            if (now is None):
+                now = datetime.datetime.now()
+            return self.recurrence.next_occurrence(now, self.alarm_hour, self.alarm_minutes)
+
+        def get_time_as_string(self, alarm_time=None, now=None):
+            if (now is None):
+                now = datetime.datetime.now()
+            if (alarm_time is None):
+                alarm_time = self.alarmtime(now)
+
+            delta = alarm_time - now
             
             # locale.setlocale(locale.LC_ALL, 'de.DE')
             
             if (delta.days > 0):
-                return ("{0:s} {1:02d}:{2:02d}".format(self.alarmtime().strftime('%a'),self.alarm_hour, self.alarm_minutes))
+                return ("{0:s} {1:02d}:{2:02d}".format(alarm_time.strftime('%a'),self.alarm_hour, self.alarm_minutes))
             else:
                 return ("{0:02d}:{1:02d}".format(self.alarm_hour, self.alarm_minutes))
             
@@ -1101,35 +1641,64 @@ class Alarm(object):
         def alarm_in_minutes(self):
 
             now = datetime.datetime.now()
-            alarmtime = self.alarmtime()
+            alarmtime = self.alarmtime(now)
             
             delta = (alarmtime-now)
             return int(delta.total_seconds()/60)
                                     
-        def add_days_based_on_trigger(self, alarmtime):
+        @staticmethod
+        def parse_date(date):
+            if (isinstance(date, datetime.date)):
+                return date
+            return datetime.datetime.strptime(date, "%Y-%m-%d").date()
+        
+class NextAlarm(object):
+    """ Immutable result of the next alarm computation in Clock. valid_until
+        is the moment it has to be recomputed: when the alarm fired, or when
+        the displayed time string loses its weekday (alarm less than a day away).
+    """
+
+    __slots__ = ("alarm", "fire_time", "time_string", "valid_until")
+
+    def __init__(self, alarm, fire_time, now):
+        set_attr = super(NextAlarm, self).__setattr__
+        set_attr("alarm", alarm)
+        set_attr("fire_time", fire_time)
+        set_attr("time_string", alarm.get_time_as_string(fire_time, now))
+        one_day_before = fire_time - datetime.timedelta(days=1)
+        set_attr("valid_until", one_day_before if now < one_day_before else fire_time)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("NextAlarm is immutable")
+
+    def minutes_until(self, now):
+        return int((self.fire_time - now).total_seconds()/60)
+
+    def __str__(self):
+        return ("NextAlarm: {0} at {1}".format(self.alarm, self.fire_time))
 
-            
-            if ("alldays" == self.alarmtrigger):
-                # no need to add a day on daily alarms
-                return alarmtime
-            
-            if ("weekdays" == self.alarmtrigger):
-                while (alarmtime.weekday() > 4):
-                    alarmtime = alarmtime + datetime.timedelta(days=1)
-                return alarmtime
-            
-            if ("weekend" == self.alarmtrigger):
-                print ("in weekend trigger")
-                while (alarmtime.weekday() < 5):
-                    alarmtime = alarmtime + datetime.timedelta(days=1)
-                return alarmtime    
-        
 class LichtWecker(Component):
     """ Main class of the LichtWecker, it creates and holds all helper classes
      
         """
+
+    DEFAULT_ALARMS = 2
+    MAX_ALARMS = 14 # a week of different alarms for two sleepers
+
+    # components only created when their state is entered for the first time
+    LAZY_COMPONENTS = {
+        "menu": Menu,
+        "setsnooze": SetSnooze,
+        "setalarm": SetAlarm,
+        "rereadusb": RereadUsb,
+        "alarmhandler": AlarmHandler,
+        "readwlanconfig": ReadWlanConfig,
+    }
+
     def __init__(self):
 
+        self.started_at = time.monotonic()
+
         # self.channel = "lichtwecker"
 
         self.states = [
@@ -1153,24 +1722,34 @@ class LichtWecker(Component):
         if (debug): print ("Initializer of Lichtwecker")
 
         # Initialize Helper Classes
-        self.config = Config() # config must be first
-        self.settings = EasySettings('lichtwecker.settings', name='LichtWecker', version='1.0')
-        if (not self.settings.has_option("firstrun")):
-            self.initialize_settings() 
-        self.audio = helpers.Audio()
-        self.led = helpers.LED(self)
-        self.lcd = helpers.Display()
-        self.buttons = Buttons(self)
-
-        # register Components
-        self.clock = Clock(self).register(self)
-        self.menu = Menu(self).register(self)
-        self.boot = Boot(self).register(self)
-        self.setsnooze = SetSnooze(self).register(self)
-        self.setalarm = SetAlarm(self).register(self)
-        self.rereadusb = RereadUsb(self).register(self)
-        self.alarmhandler = AlarmHandler(self).register(self)
-        self.readwlanconfig = ReadWlanConfig(self).register(self)
+        with profiler.phase("config"):
+            self.config = Config() # config must be first
+        with profiler.phase("settings"):
+            # changes are written behind, after a quiet period or a transaction
+            self.settings = SettingsStore('lichtwecker.settings', name='LichtWecker', version='1.0')
+            with self.settings.transaction():
+                if (not self.settings.has_option("firstrun")):
+                    self.initialize_settings() 
+                self.migrate_settings()
+            self._alarm_count = self.settings.get("alarm_count")
+            self.settings.subscribe("alarm_count", self.alarm_count_changed)
+        with profiler.phase("audio"):
+            self.audio = Audio(timeout=float(self.config.value("mpd_timeout", 10)))
+        self.ramp_minutes = float(self.config.value("ramp_minutes", AlarmHandler.RAMP_MINUTES))
+        with profiler.phase("led"):
+            self.led = LED(self)
+        with profiler.phase("lcd"):
+            self.lcd = Display()
+        with profiler.phase("buttons"):
+            self.buttons = Buttons(self)
+
+        # register Components needed right from the start, the others
+        # are created by start_state when they are used first
+        with profiler.phase("components"):
+            self.components = {}
+            self.clock = Clock(self).register(self)
+            self.boot = Boot(self).register(self)
+            self.fader = Fader(self).register(self)
         
 
 #### EVENT HANDLERS ####
@@ -1201,7 +1780,7 @@ class LichtWecker(Component):
             if (target == "menu"):
                 self.start_state(target)
             if (target =="alarmhandler"):
-                self.start_state(target, args[1])
+                self.start_state(target, *args[1:])
 
         if (sender.channel == "rereadusb"):
             self.start_state("clock")
@@ -1217,6 +1796,7 @@ class LichtWecker(Component):
             
         if (sender.channel == "alarmhandler"):
             self.start_state("clock")
+            self.boot.retry_music_refresh()
 
         if (sender.channel == "menu"):
             selected_menu_entry = args[0]
@@ -1231,6 +1811,12 @@ class LichtWecker(Component):
                 else:
                     self.start_state(newstate)
 
+    def log_first_clock_frame(self):
+        seconds = time.monotonic() - self.started_at
+        logging.info("time to first clock frame: {0:.2f}s".format(seconds))
+        if (debug): print ("Time to first clock frame: {0:.2f}s".format(seconds))
+        profiler.report()
+
     # called from Button Class. when a button was pressed 
     def buttonpress_received(self, key):
         if (debug): print ("Button pressed, will send key: {0:d} to : {1:s}".format(key, self.current_state))
@@ -1242,9 +1828,17 @@ class LichtWecker(Component):
     def unregistered(self, *args):
         if (debug): print ("Unregistered aus Lichtwecker. Parent: {0:s} -> Child: {1:s}".format(args[1].name, args[0].name))
 
+    def component(self, state):
+        """ the component of a state, lazy ones are created on first use """
+        if (state in self.LAZY_COMPONENTS and state not in self.components):
+            with profiler.phase("create {}".format(state)):
+                self.components[state] = self.LAZY_COMPONENTS[state](self).register(self)
+        return self.components.get(state)
+
     def start_state(self, newstate, *args):
         
         if (debug): print ("Starting new state: {}".format(newstate))
+        self.component(newstate)
         self.current_state = newstate
         if (len(args) > 0):
             self.fire(start_component_event(*args), self.current_state)
@@ -1260,19 +1854,40 @@ class LichtWecker(Component):
         
         self.settings.setsave ("lcd_brightness", 80)
         
-        self.settings.setsave ("alarm_1_enabled",False)
-        self.settings.setsave ("alarm_1_title",0)
-        self.settings.setsave ("alarm_1_minutes",0)
-        self.settings.setsave ("alarm_1_hours",0)
-        self.settings.setsave ("alarm_1_trigger", "weekend")
-        self.settings.setsave ("alarm_1_with_light", "on")
-        
-        self.settings.setsave ("alarm_2_enabled",False)
-        self.settings.setsave ("alarm_2_title",0)
-        self.settings.setsave ("alarm_2_minutes",0)
-        self.settings.setsave ("alarm_2_hours",0)
-        self.settings.setsave ("alarm_2_trigger", "weekend")
-        self.settings.setsave ("alarm_2_with_light", "on")
+        self.settings.setsave ("alarm_count", self.DEFAULT_ALARMS)
+        for alarm_num in range(1, self.DEFAULT_ALARMS + 1):
+            self.settings.setsave ("alarm_{0:d}_enabled".format(alarm_num),False)
+            self.settings.setsave ("alarm_{0:d}_title".format(alarm_num),"")
+            self.settings.setsave ("alarm_{0:d}_minutes".format(alarm_num),0)
+            self.settings.setsave ("alarm_{0:d}_hours".format(alarm_num),0)
+            self.settings.setsave ("alarm_{0:d}_trigger".format(alarm_num), "weekend")
+            self.settings.setsave ("alarm_{0:d}_with_light".format(alarm_num), "on")
+
+    def migrate_settings(self):
+        """ bring settings files of older versions up to date """
+        if (not self.settings.has_option("alarm_count")):
+            # from the times of the two fixed alarm slots
+            if (debug): print ("Migrating settings: two fixed alarms -> alarm_count")
+            self.settings.setsave ("alarm_count", self.DEFAULT_ALARMS)
+
+    def migrate_alarm_titles(self):
+        """ alarms used to store their music as position in the playlist,
+            which points to another song after the USB stick was read in
+            again. So before that happens, store the file instead.
+        """
+        for alarm_num in range(1, self.alarm_count() + 1):
+            title = self.settings.alarm(alarm_num).title
+            if (isinstance(title, int) and not isinstance(title, bool)):
+                uri = self.audio.uri_at(title)
+                if (uri is not None):
+                    if (debug): print ("Migrating settings: alarm {0:d} title {1:d} -> {2:s}".format(alarm_num, title, uri))
+                    self.settings.setsave ("alarm_{0:d}_title".format(alarm_num), uri)
+
+    def alarm_count(self):
+        return self._alarm_count
+
+    def alarm_count_changed(self, option, value):
+        self._alarm_count = value
         
         
         
@@ -1,5 +1,8 @@
 import RPi.GPIO as GPIO
+import threading
 import time
+from . import charset
+from .glyphs import GlyphCache, SLOTS as GLYPH_SLOTS
 
 '''
 
@@ -27,13 +30,74 @@ class Display:
     LCD_LINE_1 = 0x80 # LCD RAM address for the 1st line
     LCD_LINE_2 = 0xC0 # LCD RAM address for the 2nd line
 
-    # Timing constants
-    E_PULSE = 0.0005
-    E_DELAY = 0.0005
+    LCD_LINES = (LCD_LINE_1, LCD_LINE_2)
+
+    DDRAM_WIDTH = 40 # characters per line the controller stores, the display shows 16
+
+    LCD_RETURN_HOME = 0x02 # cursor to 0, display shift back to 0
+    LCD_SET_CGRAM = 0x40 # | slot << 3, followed by the 8 rows of the glyph
+    LCD_SHIFT_LEFT = 0x18 # move the whole display (both lines) one column
+
+    # marquee of texts longer than the display (seconds)
+    MARQUEE_PAUSE = 1.5 # at the start and at the end of the text
+    MARQUEE_INTERVAL = 0.4 # between two steps
+
+    DATA_PINS = [LCD_D4, LCD_D5, LCD_D6, LCD_D7]
+
+    # Timing constants (HD44780 datasheet)
+    E_PULSE = 0.00000045 # Enable pulse width (450ns)
+    E_DELAY = 0.000037   # execution time of most instructions (37us)
+    CLEAR_DELAY = 0.00153 # clear display and return home
+    INIT_DELAY = 0.0045  # during the initialisation sequence
+
+    # pin states of D4-D7 for the high and the low nibble of every byte
+    NIBBLES = [
+        (
+            tuple(bool(byte & (0x10 << bit)) for bit in range(4)),
+            tuple(bool(byte & (0x01 << bit)) for bit in range(4)),
+        )
+        for byte in range(256)
+    ]
+
+    # a code charset never produces (U+0080 ... U+009F become "?"), for
+    # framebuffer cells whose content is not known
+    UNKNOWN_CODE = 0x88
 
     def __init__(self):
+        # in memory copy of what is currently shown on the display (DDRAM),
+        # used to send only the characters which actually changed
+        self._shadow = {}
+
+        # custom characters in CGRAM, uploaded when text uses them
+        self.glyphs = GlyphCache()
+        self._uploads = {} # slot -> rows, waiting for the writer thread
+        self._pulse_wait = self.E_PULSE
+
+        # what callers want to see on the display; the writer thread brings
+        # the shadow (= the hardware) in line with it
+        self._target = {}
+        self._dirty = {} # line -> time it was first changed since its last flush
+        self._cond = threading.Condition()
+        self._bus = threading.RLock() # held while talking to the controller
+        self._writing = False
+
+        # text scrolling by display shift, see lcd_marquee
+        self._marquee = None
+        self._home_pending = False
+
+        # statistics of the write queue
+        self.requests = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
         self.setup_gpio()
+        self._calibrate()
         self.initializeLcdDisplay()
+
+        self._writer = threading.Thread(target=self._writer_loop, name="LCDWriter", daemon=True)
+        self._writer.start()
     
     def setup_gpio(self):
         GPIO.setwarnings(False)
@@ -46,14 +110,40 @@ class Display:
         GPIO.setup(self.LCD_D7, GPIO.OUT) # DB7
 
     def initializeLcdDisplay(self):
-        # Initialise display
+        # Initialise display (the controller is slow while still in 8 bit mode)
         self.lcd_byte(0x33,self.LCD_CMD) # 110011 Initialise
+        time.sleep(self.INIT_DELAY)
         self.lcd_byte(0x32,self.LCD_CMD) # 110010 Initialise
+        time.sleep(self.INIT_DELAY)
         self.lcd_byte(0x06,self.LCD_CMD) # 000110 Cursor move direction
         self.lcd_byte(0x0C,self.LCD_CMD) # 001100 Display On,Cursor Off, Blink Off
         self.lcd_byte(0x28,self.LCD_CMD) # 101000 Data length, number of lines, font size
         self.lcd_byte(0x01,self.LCD_CMD) # 000001 Clear display
-        time.sleep(self.E_DELAY)
+        time.sleep(self.CLEAR_DELAY)
+        with self._cond:
+            # clearing also undid any display shift
+            self._marquee = None
+            self._home_pending = False
+            for line in self.LCD_LINES:
+                self._target[line] = bytearray(b" " * self.LCD_WIDTH)
+        self.invalidate(cleared=True)
+
+    def invalidate(self, cleared=False):
+        """ forget the framebuffer contents, so the next write sends everything.
+            After a clear display command the content is known to be blanks.
+        """
+        with self._bus:
+            for line in self.LCD_LINES:
+                if (cleared):
+                    self._shadow[line] = bytearray(b" " * self.LCD_WIDTH)
+                else:
+                    # every column differs from whatever is written next
+                    self._shadow[line] = bytearray([self.UNKNOWN_CODE] * self.LCD_WIDTH)
+        if (not cleared):
+            with self._cond:
+                for line in self.LCD_LINES:
+                    self._mark_dirty(line)
+                self._cond.notify()
 
     def lcd_byte(self, bits, mode):
         # Send byte to data pins
@@ -61,54 +151,291 @@ class Display:
         # mode = True  for character
         #        False for command
 
+        high, low = self.NIBBLES[bits]
+
         GPIO.output(self.LCD_RS, mode) # RS
 
-        # High bits
-        GPIO.output(self.LCD_D4, False)
-        GPIO.output(self.LCD_D5, False)
-        GPIO.output(self.LCD_D6, False)
-        GPIO.output(self.LCD_D7, False)
-        if bits&0x10==0x10:
-            GPIO.output(self.LCD_D4, True)
-        if bits&0x20==0x20:
-            GPIO.output(self.LCD_D5, True)
-        if bits&0x40==0x40:
-            GPIO.output(self.LCD_D6, True)
-        if bits&0x80==0x80:
-            GPIO.output(self.LCD_D7, True)
-
-        # Toggle 'Enable' pin
+        # High bits, all four data pins at once
+        GPIO.output(self.DATA_PINS, high)
         self.lcd_toggle_enable()
 
         # Low bits
-        GPIO.output(self.LCD_D4, False)
-        GPIO.output(self.LCD_D5, False)
-        GPIO.output(self.LCD_D6, False)
-        GPIO.output(self.LCD_D7, False)
-        if bits&0x01==0x01:
-            GPIO.output(self.LCD_D4, True)
-        if bits&0x02==0x02:
-            GPIO.output(self.LCD_D5, True)
-        if bits&0x04==0x04:
-            GPIO.output(self.LCD_D6, True)
-        if bits&0x08==0x08:
-            GPIO.output(self.LCD_D7, True)
-
-        # Toggle 'Enable' pin
+        GPIO.output(self.DATA_PINS, low)
         self.lcd_toggle_enable()
 
     def lcd_toggle_enable(self):
-        # Toggle enable
-        time.sleep(self.E_DELAY)
+        # Toggle enable, then give the controller time to execute
         GPIO.output(self.LCD_E, True)
-        time.sleep(self.E_PULSE)
+        if (self._pulse_wait > 0):
+            self._busy_wait(self._pulse_wait)
         GPIO.output(self.LCD_E, False)
-        time.sleep(self.E_DELAY)
+        self._busy_wait(self.E_DELAY)
+
+    def _busy_wait(self, seconds):
+        # time.sleep() can not do microseconds, it oversleeps by 50us or more
+        deadline = time.perf_counter() + seconds
+        while (time.perf_counter() < deadline):
+            pass
+
+    def _calibrate(self):
+        """ measure how long a GPIO write takes. If that alone is longer than 
+            the E pulse, there is no need to busy wait during the pulse.
+        """
+        samples = []
+        for _ in range(5):
+            started = time.perf_counter()
+            GPIO.output(self.LCD_E, False)
+            samples.append(time.perf_counter() - started)
+        gpio_write_time = sorted(samples)[len(samples) // 2]
+        self._pulse_wait = max(0.0, self.E_PULSE - gpio_write_time)
 
     def lcd_string(self,message,line):
-        # Send string to display
-        message = message.ljust(self.LCD_WIDTH," ")
-        self.lcd_byte(line, self.LCD_CMD)
+        # Send string to display (whole line, padded with blanks)
+        message = charset.normalize(message).ljust(self.LCD_WIDTH," ")
+        self.lcd_write(message, line, 0)
+
+    def lcd_write(self, text, line, column=0):
+        """ write text into line starting at column, leaving the rest of the
+            line untouched. This only queues the change and returns at once,
+            the writer thread sends it. If a line changes several times
+            before it is sent, only its latest content goes to the display.
+        """
+        text = charset.normalize(text)
+        with self._cond:
+            # the controller only knows the 8 bit codes of its character ROM
+            # and the glyphs in CGRAM
+            codes = charset.encode(self._map_glyphs(text))[:self.LCD_WIDTH - column]
+            end = column + len(codes)
+            self.requests += 1
+            if (self._marquee is not None and self._marquee["line"] == line):
+                self._stop_marquee()
+            self._target[line][column:end] = codes
+            self._mark_dirty(line)
+            self._cond.notify()
+
+    def lcd_marquee(self, text, line):
+        """ show text in line. If it is longer than the display, it scrolls
+            until its end is visible and starts over, up to DDRAM_WIDTH 
+            characters. The text is written into the controller's memory 
+            once, every step is a single display shift command.
+
+            The controller shifts both lines, so the other line moves along.
+            Writing to the line (lcd_string, lcd_write) stops the marquee.
+        """
+        text = charset.normalize(text)
+        if (len(charset.encode(text)) <= self.LCD_WIDTH):
+            self.lcd_string(text, line)
+            return
+
+        with self._cond:
+            codes = charset.encode(self._map_glyphs(text))[:self.DDRAM_WIDTH]
+            self.requests += 1
+            if (self._marquee is not None):
+                self._stop_marquee()
+            self._target[line][:] = codes[:self.LCD_WIDTH]
+            self._mark_dirty(line)
+            self._marquee = {
+                "line": line,
+                "tail": codes[self.LCD_WIDTH:].ljust(self.DDRAM_WIDTH - self.LCD_WIDTH),
+                "written": False,
+                "steps": len(codes) - self.LCD_WIDTH,
+                "shift": 0,
+                "next": time.perf_counter() + self.MARQUEE_PAUSE,
+            }
+            self._cond.notify()
+
+    def _map_glyphs(self, text):
+        """ replace characters which have a glyph by their CGRAM code. Glyphs
+            on the screen keep their slots, if there is no slot left the
+            character stays and charset falls back to the ROM.
+            Caller holds self._cond.
+        """
+        if (self.glyphs.chars.isdisjoint(text)):
+            return text
+
+        pinned = set(code for codes in self._target.values() for code in codes if code < GLYPH_SLOTS)
+        if (self._marquee is not None):
+            pinned.update(code for code in self._marquee["tail"] if code < GLYPH_SLOTS)
+
+        chars = []
+        for char in text:
+            if (char in self.glyphs.chars):
+                slot = self.glyphs.slot_for(char, pinned)
+                if (slot is not None):
+                    slot, rows = slot
+                    pinned.add(slot)
+                    if (rows is not None):
+                        self._uploads[slot] = rows
+                    char = chr(slot)
+            chars.append(char)
+        return "".join(chars)
+
+    def _upload_glyphs(self, uploads):
+        """ write glyphs into CGRAM. Cells showing a slot's old glyph are 
+            marked unknown, so they get rewritten. Caller holds self._bus.
+        """
+        for slot, rows in uploads.items():
+            self.lcd_byte(self.LCD_SET_CGRAM | (slot << 3), self.LCD_CMD)
+            for row in rows:
+                self.lcd_byte(row, self.LCD_CHR)
+            for line, shadow in self._shadow.items():
+                for column, code in enumerate(shadow):
+                    if (code == slot):
+                        shadow[column] = self.UNKNOWN_CODE
+
+    def _stop_marquee(self):
+        # caller holds self._cond
+        self._marquee = None
+        self._home_pending = True
+
+    def flush(self, timeout=None):
+        """ block until everything queued has been sent to the display """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._dirty and not self._writing, timeout)
+
+    def queue_depth(self):
+        """ number of lines waiting to be sent """
+        with self._cond:
+            return len(self._dirty)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queue_depth": len(self._dirty),
+                "requests": self.requests,
+                "coalesced": self.coalesced,
+                "flushes": self.flushes,
+                "last_flush_latency": self.last_flush_latency,
+                "max_flush_latency": self.max_flush_latency,
+                "glyph_uploads": self.glyphs.uploads,
+                "glyph_evictions": self.glyphs.evictions,
+            }
+
+    def _mark_dirty(self, line):
+        # caller holds self._cond
+        if (line in self._dirty):
+            self.coalesced += 1
+        else:
+            self._dirty[line] = time.perf_counter()
+
+    def _has_work(self):
+        # caller holds self._cond
+        if (self._dirty or self._home_pending or self._uploads):
+            return True
+        marquee = self._marquee
+        return marquee is not None and (not marquee["written"] or time.perf_counter() >= marquee["next"])
+
+    def _marquee_step(self):
+        """ what the marquee needs sent now: (tail to write or None, command
+            or None). Caller holds self._cond.
+        """
+        marquee = self._marquee
+        if (marquee is None):
+            return (None, None)
+
+        tail = None
+        if (not marquee["written"]):
+            marquee["written"] = True
+            tail = marquee["tail"]
+
+        command = None
+        now = time.perf_counter()
+        if (now >= marquee["next"]):
+            if (marquee["shift"] < marquee["steps"]):
+                command = self.LCD_SHIFT_LEFT
+                marquee["shift"] += 1
+                at_end = marquee["shift"] == marquee["steps"]
+                marquee["next"] = now + (self.MARQUEE_PAUSE if at_end else self.MARQUEE_INTERVAL)
+            else:
+                command = self.LCD_RETURN_HOME
+                marquee["shift"] = 0
+                marquee["next"] = now + self.MARQUEE_PAUSE
+        return (tail, command)
+
+    def _writer_loop(self):
+        while True:
+            with self._cond:
+                timeout = None
+                if (self._marquee is not None):
+                    timeout = max(0.0, self._marquee["next"] - time.perf_counter())
+                self._cond.wait_for(self._has_work, timeout)
+                # glyphs and the text using them are taken together, so no
+                # text goes out before the glyph it needs is in CGRAM
+                uploads = self._uploads
+                self._uploads = {}
+                pending = [(line, bytes(self._target[line]), queued) for line, queued in self._dirty.items()]
+                if (uploads):
+                    # a slot's old glyph may be shown on any line. They are
+                    # compared to the shadow again, unchanged cells cost nothing
+                    pending += [(line, bytes(self._target[line]), None) for line in self.LCD_LINES if line not in self._dirty]
+                self._dirty.clear()
+                self._writing = True
+                home = self._home_pending
+                self._home_pending = False
+                marquee_line = self._marquee["line"] if self._marquee is not None else None
+                tail, command = self._marquee_step()
+
+            with self._bus:
+                if (uploads):
+                    self._upload_glyphs(uploads)
+                if (home):
+                    self._return_home()
+                for line, codes, queued in pending:
+                    self._send_line(line, codes)
+                if (tail is not None):
+                    # the rest of the text, behind the visible columns
+                    self.lcd_byte(marquee_line + self.LCD_WIDTH, self.LCD_CMD)
+                    for code in tail:
+                        self.lcd_byte(code, self.LCD_CHR)
+                if (command == self.LCD_RETURN_HOME):
+                    self._return_home()
+                elif (command is not None):
+                    self.lcd_byte(command, self.LCD_CMD)
+
+            with self._cond:
+                self._writing = False
+                for line, codes, queued in pending:
+                    if (queued is None):
+                        # only rewritten for a new glyph
+                        continue
+                    latency = time.perf_counter() - queued
+                    self.last_flush_latency = latency
+                    self.max_flush_latency = max(self.max_flush_latency, latency)
+                    self.flushes += 1
+                self._cond.notify_all()
+
+    def _return_home(self):
+        self.lcd_byte(self.LCD_RETURN_HOME, self.LCD_CMD)
+        self._busy_wait(self.CLEAR_DELAY)
+
+    def _send_line(self, line, codes):
+        """ Only runs of characters which differ from the framebuffer are 
+            sent, each preceded by a cursor address command.
+        """
+        shadow = self._shadow[line]
+        end = len(codes)
+
+        col = 0
+        while (col < end):
+            # skip characters already shown
+            if (shadow[col] == codes[col]):
+                col += 1
+                continue
+
+            # find the end of the changed run; a single unchanged character
+            # costs the same as a new address command, so it gets merged
+            run_end = col + 1
+            while (run_end < end):
+                if (shadow[run_end] != codes[run_end]):
+                    run_end += 1
+                elif (run_end + 1 < end and shadow[run_end + 1] != codes[run_end + 1]):
+                    run_end += 2
+                else:
+                    break
+
+            self.lcd_byte(line + col, self.LCD_CMD) # set DDRAM address
+            for i in range(col, run_end):
+                self.lcd_byte(codes[i], self.LCD_CHR)
+                shadow[i] = codes[i]
 
-        for i in range(self.LCD_WIDTH):
-            self.lcd_byte(ord(message[i]),self.LCD_CHR)
+            col = run_end
@@ -0,0 +1,46 @@
+import math
+
+'''
+
+Easing curves, shared by all fades (audio volume and light).
+Each curve maps progress 0.0 ... 1.0 to 0.0 ... 1.0
+
+'''
+
+# dynamic range of the perceptual curve in decades (2 = 40dB)
+LOG_DECADES = 2.0
+
+
+def linear(progress):
+    return progress
+
+def log(progress):
+    """ perceptual curve: equal steps in time are equal steps in dB, so a
+        fade sounds (or looks) even instead of jumping up at the start
+    """
+    return (math.pow(10.0, LOG_DECADES * progress) - 1.0) / (math.pow(10.0, LOG_DECADES) - 1.0)
+
+def ease_in(progress):
+    return progress * progress
+
+def ease_out(progress):
+    return 1.0 - (1.0 - progress) * (1.0 - progress)
+
+def ease_in_out(progress):
+    # smoothstep
+    return progress * progress * (3.0 - 2.0 * progress)
+
+
+CURVES = {
+    "linear": linear,
+    "log": log,
+    "ease_in": ease_in,
+    "ease_out": ease_out,
+    "ease_in_out": ease_in_out,
+}
+
+def get(curve):
+    """ look up a curve by name, callables are passed through """
+    if (callable(curve)):
+        return curve
+    return CURVES[curve]
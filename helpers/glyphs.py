@@ -0,0 +1,87 @@
+from collections import OrderedDict
+
+'''
+
+Glyphs: characters of our own for the 8 CGRAM slots of the display
+
+A glyph is 8 rows of 5 pixels (bit 4 is the left column). Text uses
+them by their character, Display puts them into a slot when they show up
+and falls back to the character ROM (see charset) when all slots are in
+use on the screen.
+
+'''
+
+SLOTS = 8
+
+
+def _bar(columns):
+    # the left columns of a cell filled, for progress bars
+    return tuple([(0x1F << (5 - columns)) & 0x1F] * 8)
+
+
+GLYPHS = {
+    "Ä": (0x0A, 0x00, 0x0E, 0x11, 0x11, 0x1F, 0x11, 0x00),
+    "Ö": (0x0A, 0x00, 0x0E, 0x11, 0x11, 0x11, 0x0E, 0x00),
+    "Ü": (0x0A, 0x00, 0x11, 0x11, 0x11, 0x11, 0x0E, 0x00),
+    "🔔": (0x04, 0x0E, 0x0E, 0x0E, 0x1F, 0x00, 0x04, 0x00),
+    "▏": _bar(1),
+    "▎": _bar(2),
+    "▍": _bar(3),
+    "▌": _bar(4),
+}
+
+BELL = "🔔"
+
+# a cell filled by 1 ... 4 of its 5 columns, the full block is in the ROM
+PARTIAL_BLOCKS = "▏▎▍▌"
+FULL_BLOCK = "█"
+
+
+def progress_bar(fraction, width):
+    """ text of width cells, filled from the left up to fraction (0 ... 1),
+        in steps of one pixel column
+    """
+    columns = int(round(max(0.0, min(1.0, fraction)) * width * 5))
+    full, rest = divmod(columns, 5)
+    text = FULL_BLOCK * full
+    if (rest):
+        text += PARTIAL_BLOCKS[rest - 1]
+    return text.ljust(width)
+
+
+class GlyphCache(object):
+    """ which glyph is in which slot. When all slots are taken, the least
+        recently used glyph which is not pinned (on the screen) makes room.
+    """
+
+    def __init__(self, glyphs=GLYPHS):
+        self.glyphs = glyphs
+        self.chars = frozenset(glyphs)
+        self._slots = OrderedDict() # char -> slot, least recently used first
+        self._free = list(range(SLOTS))
+        self.uploads = 0
+        self.evictions = 0
+
+    def slot_for(self, char, pinned=()):
+        """ (slot, rows) for the glyph of char, rows are None if the glyph
+            is in the slot already, otherwise they need to be uploaded.
+            None if every slot is pinned.
+        """
+        if (char in self._slots):
+            self._slots.move_to_end(char)
+            return (self._slots[char], None)
+
+        if (self._free):
+            slot = self._free.pop(0)
+        else:
+            for old_char, slot in self._slots.items():
+                if (slot not in pinned):
+                    break
+            else:
+                return None
+            del self._slots[old_char]
+            self.evictions += 1
+
+        self._slots[char] = slot
+        self.uploads += 1
+        return (slot, self.glyphs[char])
@@ -1,7 +1,11 @@
 import RPi.GPIO as GPIO
+import threading
+import time
 
 class LED(object):
 
+    DEFAULT_PWM_FREQUENCY = 100 # Hz, config key pwm_frequency
+
     def __init__(self, lichtwecker):
 
         self.lw = lichtwecker
@@ -12,8 +16,10 @@ class LED(object):
         self.GREEN = int(self.lw.config.value("green"))
         self.LCD_BG = int(self.lw.config.value("lcd_bg"))
 
+        self.frequency = float(self.lw.config.value("pwm_frequency", self.DEFAULT_PWM_FREQUENCY))
+
         # used for the self test / boot screen
-        self.names = { 
+        self.names = {
             self.RED: "ROT",
             self.WARM_WHITE: "WARMWEISS",
             self.GREEN: "GRUEN",
@@ -25,33 +31,73 @@ class LED(object):
         GPIO.setwarnings(False)
         GPIO.setmode(GPIO.BCM)
 
-        GPIO.setup(self.RED, GPIO.OUT, initial=GPIO.LOW) 
+        GPIO.setup(self.RED, GPIO.OUT, initial=GPIO.LOW)
         GPIO.setup(self.WARM_WHITE, GPIO.OUT, initial=GPIO.LOW)
         GPIO.setup(self.GREEN, GPIO.OUT, initial=GPIO.LOW)
         GPIO.setup(self.LCD_BG, GPIO.OUT, initial=GPIO.LOW)
 
-        self.redPWM = GPIO.PWM(self.RED, 100)
-        self.redPWM.start(0)
-        self.greenPWM = GPIO.PWM(self.GREEN, 100)
-        self.greenPWM.start(0)
-        self.wharm_whitePWM = GPIO.PWM(self.WARM_WHITE, 100)
-        self.wharm_whitePWM.start(0)
-        self.lcd_bgPWM = GPIO.PWM(self.LCD_BG, 100)
-        self.lcd_bgPWM.start(0)
+        # RPi.GPIO's software PWM costs a thread per channel, even at 0%.
+        # So the thread is stopped while a channel is off. Full on stays
+        # PWM at 100%: a stopped thread drives its pin low when it ends
+        # (up to one period later), which would turn a HIGH output off.
+        self._pwm = {}
+        self._duty = {}
+        self._pwm_running = {}
+        self._pwm_stopped = {}
+        for led in self.names.keys():
+            self._pwm[led] = GPIO.PWM(led, self.frequency)
+            self._duty[led] = 0.0
+            self._pwm_running[led] = False
+            self._pwm_stopped[led] = 0.0
 
-
-        self._led_to_pwm = { 
-            self.RED: self.redPWM,
-            self.WARM_WHITE: self.wharm_whitePWM,
-            self.GREEN: self.greenPWM,
-            self.LCD_BG: self.lcd_bgPWM,
-            }
+        # brightness is set from the event loop and from fades in threads
+        self._lock = threading.Lock()
 
 
     # retrieve color names, for pin numbers
     def name_for_led(self, led_pin):
         return self.names[led_pin]
 
+    # current brightness of a LED
+    def brightness(self, led):
+        return self._duty[led]
+
     # set brightness for the LEDs
     def set_brightness(self, led, percentage):
-        self._led_to_pwm[led].ChangeDutyCycle(float(percentage))
+        with self._lock:
+            self._set(led, float(percentage))
+
+    def set_rgbw(self, red=None, green=None, warm_white=None, lcd_bg=None):
+        """ set several channels at once, channels given as None stay as they are """
+        with self._lock:
+            for led, percentage in ((self.RED, red), (self.GREEN, green), (self.WARM_WHITE, warm_white), (self.LCD_BG, lcd_bg)):
+                if (percentage is not None):
+                    self._set(led, float(percentage))
+
+    def _set(self, led, percentage):
+        # caller holds self._lock
+        percentage = min(percentage, 100.0)
+        if (percentage == self._duty[led]):
+            return
+        self._duty[led] = percentage
+
+        pwm = self._pwm[led]
+        if (percentage <= 0):
+            if (self._pwm_running[led]):
+                pwm.stop()
+                self._pwm_running[led] = False
+                self._pwm_stopped[led] = time.monotonic()
+            GPIO.output(led, GPIO.LOW)
+        elif (self._pwm_running[led]):
+            pwm.ChangeDutyCycle(percentage)
+        else:
+            # the old thread may still be running its last period, a new
+            # one started now would share its state
+            wait = self._pwm_stopped[led] + 1.0 / self.frequency - time.monotonic()
+            if (wait > 0):
+                time.sleep(wait)
+            pwm.start(percentage)
+            # stop() dropped the channel's settings, start() came back
+            # with the library's default frequency
+            pwm.ChangeFrequency(self.frequency)
+            self._pwm_running[led] = True
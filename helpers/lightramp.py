@@ -0,0 +1,117 @@
+from array import array
+import bisect
+from . import easing
+
+'''
+
+Light ramps (sunrise): a profile of keyframes is compiled once into a
+flat table of duty cycles, so looking up the light at some moment is
+just an index into an array.
+
+'''
+
+
+class RampProfile(object):
+    """ keyframes are (position, (value, value, ...)) with position going
+        from 0.0 (start) to 1.0 (end) and values in perceived brightness
+        0 ... 100. Between keyframes values follow the easing curve, then
+        gamma turns perceived brightness into PWM duty cycle.
+    """
+
+    def __init__(self, keyframes, curve="linear", gamma=2.2):
+        self.keyframes = sorted(keyframes)
+        self.positions = [position for position, values in self.keyframes]
+        self.channels = len(self.keyframes[0][1])
+        self.curve = easing.get(curve)
+        self.gamma = gamma
+        self._compiled = {} # (duration, resolution) -> CompiledRamp
+
+    def value_at(self, position):
+        """ duty cycles at position (0.0 ... 1.0), slow, used for compiling """
+        index = bisect.bisect_right(self.positions, position)
+        if (index == 0):
+            values = self.keyframes[0][1]
+        elif (index == len(self.keyframes)):
+            values = self.keyframes[-1][1]
+        else:
+            start_position, start_values = self.keyframes[index - 1]
+            end_position, end_values = self.keyframes[index]
+            progress = self.curve((position - start_position) / (end_position - start_position))
+            values = [start + (end - start) * progress for start, end in zip(start_values, end_values)]
+        return [100.0 * pow(value / 100.0, self.gamma) for value in values]
+
+    def compile(self, duration, resolution=1.0):
+        """ CompiledRamp for a ramp of duration seconds, one step per resolution seconds """
+        key = (duration, resolution)
+        if (key not in self._compiled):
+            self._compiled[key] = CompiledRamp(self, duration, resolution)
+        return self._compiled[key]
+
+
+class CompiledRamp(object):
+    """ the duty cycles of every step of a ramp in one flat array, plus for
+        every step the next step with different values (for timers)
+    """
+
+    # duty cycles are rounded to this, finer steps are not visible anyway
+    DUTY_PRECISION = 0.1
+
+    __slots__ = ("duration", "resolution", "steps", "channels", "_table", "_next_change")
+
+    def __init__(self, profile, duration, resolution):
+        self.duration = duration
+        self.resolution = resolution
+        self.steps = int(duration / resolution) + 1
+        self.channels = profile.channels
+
+        self._table = array("d")
+        for step in range(self.steps):
+            position = min(1.0, step * resolution / duration)
+            for value in profile.value_at(position):
+                self._table.append(round(value / self.DUTY_PRECISION) * self.DUTY_PRECISION)
+
+        self._next_change = array("I", [self.steps] * self.steps)
+        for step in range(self.steps - 2, -1, -1):
+            if (self._row(step) != self._row(step + 1)):
+                self._next_change[step] = step + 1
+            else:
+                self._next_change[step] = self._next_change[step + 1]
+
+    def step_at(self, elapsed):
+        """ step index for elapsed seconds since the start of the ramp """
+        step = int(elapsed / self.resolution)
+        if (step < 0):
+            return 0
+        if (step >= self.steps):
+            return self.steps - 1
+        return step
+
+    def values(self, step):
+        """ tuple of duty cycles of step """
+        offset = step * self.channels
+        return tuple(self._table[offset:offset + self.channels])
+
+    def value(self, step, channel):
+        return self._table[step * self.channels + channel]
+
+    def seconds_until_change(self, elapsed):
+        """ seconds from elapsed until the values change, None if they don't anymore """
+        next_step = self._next_change[self.step_at(elapsed)]
+        if (next_step >= self.steps):
+            return None
+        return next_step * self.resolution - elapsed
+
+    def _row(self, step):
+        offset = step * self.channels
+        return self._table[offset:offset + self.channels]
+
+
+# red, green, warm white in perceived brightness; the colours of the old
+# minute table: dark red, through orange and yellow to full warm white
+SUNRISE = RampProfile([
+        (0.0,  (10, 0, 0)),
+        (0.33, (73, 46, 0)),
+        (0.45, (85, 90, 0)),
+        (0.67, (85, 90, 35)),
+        (1.0,  (85, 90, 100)),
+    ], curve="linear", gamma=2.2)
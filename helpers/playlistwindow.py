@@ -0,0 +1,130 @@
+from collections import OrderedDict
+from mpd import MPDError
+import threading
+from .titlecatalog import display_name
+
+'''
+
+PlaylistWindow: the playlist in MPD's order, fetched a page at a time
+
+Only the pages around the titles looked at are kept (least recently used
+ones are dropped), and the next page is fetched in the background before
+it is needed. So scrolling costs the same with 50 or 50000 titles.
+
+'''
+
+
+class PlaylistWindow(object):
+    """ looks like a list of playlist entries (dicts like MPD's playlistinfo),
+        and like a TitleOrder for the music picker
+    """
+
+    PAGE_SIZE = 32 # titles per playlistinfo query
+    PAGES = 4 # pages kept
+
+    name = "playlist"
+
+    def __init__(self, audio, page_size=PAGE_SIZE, pages=PAGES):
+        self.audio = audio
+        self.page_size = page_size
+        self.max_pages = pages
+
+        self._lock = threading.Lock()
+        self._pages = OrderedDict() # page number -> list of entries, oldest use first
+        self._prefetching = set()
+        self.version = None # MPD's playlist version the pages belong to
+        self.length = 0
+
+        self.fetches = 0 # playlistinfo queries, for the statistics
+
+    def refresh(self):
+        """ forget all pages if the playlist changed since they were fetched """
+        version, length = self.audio.playlist_version()
+        with self._lock:
+            if (version != self.version):
+                self._pages.clear()
+                self.version = version
+            self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        if (position < 0 or position >= self.length):
+            raise IndexError("playlist position out of range: {}".format(position))
+        page, offset = divmod(position, self.page_size)
+        songs = self._page(page)
+
+        # fetch the neighbour we are moving towards before it is needed
+        if (offset >= self.page_size // 2):
+            self._prefetch(page + 1)
+        else:
+            self._prefetch(page - 1)
+
+        if (offset >= len(songs)):
+            # the playlist got shorter meanwhile
+            return {}
+        return songs[offset]
+
+    def display(self, position):
+        return display_name(self[position])
+
+    def uri(self, position):
+        return self[position].get("file", "")
+
+    def slot_of_uri(self, uri):
+        """ position of the file uri, 0 if it is not in the playlist """
+        if (not uri):
+            return 0
+        position = self.audio.find_in_playlist(uri)
+        return 0 if position is None else position
+
+    def next_group(self, position):
+        """ no groups in playlist order, jump a page ahead """
+        next_position = position + self.page_size
+        return 0 if next_position >= self.length else next_position
+
+    def _page(self, page):
+        with self._lock:
+            if (page in self._pages):
+                self._pages.move_to_end(page)
+                return self._pages[page]
+            version = self.version
+        songs = self._fetch(page)
+        self._store(page, songs, version)
+        return songs
+
+    def _fetch(self, page):
+        start = page * self.page_size
+        self.fetches += 1
+        return self.audio.playlistinfo(start, start + self.page_size)
+
+    def _store(self, page, songs, version):
+        with self._lock:
+            if (version != self.version):
+                # fetched for a playlist which changed meanwhile
+                return
+            self._pages[page] = songs
+            self._pages.move_to_end(page)
+            while (len(self._pages) > self.max_pages):
+                self._pages.popitem(last=False)
+
+    def _prefetch(self, page):
+        if (page < 0 or page * self.page_size >= self.length):
+            return
+        with self._lock:
+            if (page in self._pages or page in self._prefetching):
+                return
+            self._prefetching.add(page)
+            version = self.version
+        threading.Thread(target=self._run_prefetch, args=(page, version), name="PlaylistPrefetch", daemon=True).start()
+
+    def _run_prefetch(self, page, version):
+        try:
+            self._store(page, self._fetch(page), version)
+        except MPDError:
+            # it is fetched when it is needed then
+            pass
+        finally:
+            with self._lock:
+                self._prefetching.discard(page)
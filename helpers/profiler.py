@@ -0,0 +1,64 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+'''
+
+Startup profiler: set LW_PROFILE_STARTUP=1 in the environment to get the
+time spent in every phase of the start (imports, helper and component
+construction) printed and logged once the first clock frame is shown.
+
+'''
+
+ENABLED = os.environ.get("LW_PROFILE_STARTUP", "") not in ("", "0")
+
+_started = time.perf_counter()
+_phases = [] # (depth, name, seconds) in the order the phases ended
+_depth = 0
+
+@contextmanager
+def phase(name):
+    """ time the enclosed block as a phase, phases may be nested """
+    global _depth
+    if (not ENABLED):
+        yield
+        return
+    started = time.perf_counter()
+    _depth += 1
+    try:
+        yield
+    finally:
+        _depth -= 1
+        _phases.append((_depth, name, time.perf_counter() - started))
+
+def report(title="Startup profile"):
+    """ print and log all phases (parents before their children) """
+    if (not ENABLED or not _phases):
+        return
+    lines = ["{0:s} ({1:.3f}s since profiler import):".format(title, time.perf_counter() - _started)]
+    for depth, name, seconds in _ordered():
+        lines.append("  {0:<44s} {1:8.1f} ms".format("  " * depth + name, seconds * 1000))
+    del _phases[:]
+    for line in lines:
+        print (line)
+        logging.info(line)
+
+def _ordered():
+    # phases end children first; walking backwards and then reversing each
+    # level puts every parent in front of its children
+    result = []
+    stack = [result]
+    for depth, name, seconds in reversed(_phases):
+        while (len(stack) > depth + 1):
+            stack.pop()
+        children = []
+        stack[-1].insert(0, (depth, name, seconds, children))
+        stack.append(children)
+    flat = []
+    def walk(entries):
+        for depth, name, seconds, children in entries:
+            flat.append((depth, name, seconds))
+            walk(children)
+    walk(result)
+    return flat
@@ -0,0 +1,123 @@
+import bisect
+import datetime
+
+'''
+
+Recurrence of alarms: on which days does an alarm ring
+
+Days are a 7 bit mask, bit 0 is Monday ... bit 6 is Sunday
+(same numbering as datetime.weekday())
+
+'''
+
+MONDAY, TUESDAY, WEDNESDAY, THURSDAY, FRIDAY, SATURDAY, SUNDAY = [1 << day for day in range(7)]
+
+WEEKDAYS = MONDAY | TUESDAY | WEDNESDAY | THURSDAY | FRIDAY
+WEEKEND = SATURDAY | SUNDAY
+ALLDAYS = WEEKDAYS | WEEKEND
+
+# the named triggers stored in the settings before there were masks
+TRIGGERS = {
+    "weekdays": WEEKDAYS,
+    "weekend": WEEKEND,
+    "alldays": ALLDAYS,
+}
+
+DAY_NAMES = ["Mo", "Di", "Mi", "Do", "Fr", "Sa", "So"]
+
+# choices offered in the menu (displayname, value stored in the settings)
+DAY_CHOICES = [
+    ("Werktags", "weekdays"),
+    ("Wochenende", "weekend"),
+    ("jeden Tag", "alldays"),
+    ("Mo-Do", MONDAY | TUESDAY | WEDNESDAY | THURSDAY),
+    ("So-Do", SUNDAY | MONDAY | TUESDAY | WEDNESDAY | THURSDAY),
+] + [("nur {0:s}".format(name), 1 << day) for day, name in enumerate(DAY_NAMES)]
+
+
+class Recurrence(object):
+    """ a weekday mask plus optional extra (once) and skipped dates.
+        The next occurrence is found without stepping through the days:
+        the mask is rotated so bit 0 is the start day, then the lowest set
+        bit is the number of days to wait.
+    """
+
+    __slots__ = ("mask", "once", "skip", "_once_sorted")
+
+    def __init__(self, mask, once=(), skip=()):
+        if (mask < 0 or mask > ALLDAYS):
+            raise ValueError("weekday mask out of range: {}".format(mask))
+        self.mask = mask
+        self.once = frozenset(once)
+        self.skip = frozenset(skip)
+        self._once_sorted = sorted(self.once - self.skip)
+
+    @classmethod
+    def from_trigger(cls, trigger, once=(), skip=()):
+        """ trigger is a mask or one of the names in TRIGGERS """
+        if (isinstance(trigger, int) and not isinstance(trigger, bool)):
+            return cls(trigger, once, skip)
+        if (trigger in TRIGGERS):
+            return cls(TRIGGERS[trigger], once, skip)
+        raise ValueError("unknown alarm trigger: {}".format(trigger))
+
+    def days_until(self, weekday):
+        """ days from a day with weekday until the next day in the mask
+            (0 if the day itself is in it), None for an empty mask
+        """
+        rotated = ((self.mask >> weekday) | (self.mask << (7 - weekday))) & ALLDAYS
+        if (rotated == 0):
+            return None
+        # position of the lowest set bit
+        return (rotated & -rotated).bit_length() - 1
+
+    def next_date(self, start):
+        """ first date >= start on which the alarm rings, None if never """
+        next_date = None
+
+        if (self.mask):
+            candidate = start + datetime.timedelta(days=self.days_until(start.weekday()))
+            # each round passes one skipped date, so this ends
+            while (candidate in self.skip):
+                candidate += datetime.timedelta(days=1)
+                candidate += datetime.timedelta(days=self.days_until(candidate.weekday()))
+            next_date = candidate
+
+        index = bisect.bisect_left(self._once_sorted, start)
+        if (index < len(self._once_sorted)):
+            once_date = self._once_sorted[index]
+            if (next_date is None or once_date < next_date):
+                next_date = once_date
+
+        return next_date
+
+    def next_occurrence(self, now, hour, minute):
+        """ datetime of the next alarm at hour:minute, not before now """
+        start = now.date()
+        if (now > datetime.datetime.combine(start, datetime.time(hour, minute))):
+            # too late for today
+            start += datetime.timedelta(days=1)
+        next_date = self.next_date(start)
+        if (next_date is None):
+            return None
+        return datetime.datetime.combine(next_date, datetime.time(hour, minute))
+
+    def occurrences(self, start, end):
+        """ sorted list of all dates from start (inclusive) to end (exclusive)
+            on which the alarm rings, e.g. a whole year for display or testing
+        """
+        dates = set(date for date in self._once_sorted if start <= date < end)
+        week = datetime.timedelta(days=7)
+        for day in range(7):
+            if (self.mask & (1 << day)):
+                first = start + datetime.timedelta(days=(day - start.weekday()) % 7)
+                count = max(0, (end - first).days + 6) // 7
+                dates.update(first + week * n for n in range(count))
+        return sorted(dates - self.skip)
+
+    def describe(self):
+        """ short text for the display, like 'Mo Mi Fr' """
+        for displayname, value in DAY_CHOICES:
+            if (TRIGGERS.get(value, value) == self.mask):
+                return displayname
+        return " ".join(name for day, name in enumerate(DAY_NAMES) if self.mask & (1 << day))
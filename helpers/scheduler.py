@@ -0,0 +1,82 @@
+import heapq
+import itertools
+
+'''
+
+AlarmScheduler
+
+'''
+
+
+class AlarmScheduler(object):
+    """ holds any number of alarms in a heap ordered by their next fire time.
+        Alarms are identified by a key (the alarm number). schedule,
+        reschedule and remove are O(log n), peek is O(1).
+
+        Removed entries are only marked and dropped once they reach the top
+        of the heap (see the heapq docs), the top is always a live entry.
+    """
+
+    _REMOVED = object()
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {} # key -> [fire_time, sequence, key, payload]
+        self._sequence = itertools.count() # keeps equal fire times in insert order
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, fire_time, payload=None):
+        """ add an alarm or move an existing one to a new fire time """
+        if (key in self._entries):
+            self._mark_removed(key)
+        entry = [fire_time, next(self._sequence), key, payload]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        self._prune()
+
+    def remove(self, key):
+        if (key in self._entries):
+            self._mark_removed(key)
+            self._prune()
+
+    def clear(self):
+        self._heap = []
+        self._entries = {}
+
+    def peek(self):
+        """ (fire_time, key, payload) of the next alarm, None if there is none """
+        if (not self._heap):
+            return None
+        fire_time, sequence, key, payload = self._heap[0]
+        return (fire_time, key, payload)
+
+    def pop(self):
+        """ remove and return the next alarm like peek() does """
+        if (not self._heap):
+            return None
+        fire_time, sequence, key, payload = heapq.heappop(self._heap)
+        del self._entries[key]
+        self._prune()
+        return (fire_time, key, payload)
+
+    def get(self, key):
+        """ (fire_time, payload) of alarm key """
+        fire_time, sequence, key, payload = self._entries[key]
+        return (fire_time, payload)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def _mark_removed(self, key):
+        entry = self._entries.pop(key)
+        entry[2] = self._REMOVED
+        entry[3] = None
+
+    def _prune(self):
+        while (self._heap and self._heap[0][2] is self._REMOVED):
+            heapq.heappop(self._heap)
@@ -0,0 +1,186 @@
+import atexit
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+'''
+
+SettingsStore: EasySettings with write-behind
+
+Changes are applied in memory at once, but only written to the SD card
+after a quiet period, when a transaction ends, on commit() and at exit.
+Writing goes to a temporary file which then replaces the settings file,
+so a power cut never leaves a half written file behind.
+
+Besides the plain get(), the settings of an alarm are available as typed
+AlarmSettings records, built once and kept until one of its values
+changes. Components subscribe to options to be told about changes,
+instead of reading them over and over.
+
+'''
+
+
+class AlarmSettings(object):
+    """ all settings of one alarm, read only """
+
+    __slots__ = ("num", "hours", "minutes", "trigger", "title", "with_light", "enabled", "once", "skip")
+
+    FIELDS = {
+        # attribute: (option suffix, default)
+        "hours": ("hours", 0),
+        "minutes": ("minutes", 0),
+        "trigger": ("trigger", "weekend"),
+        "title": ("title", ""),
+        "with_light": ("with_light", "on"),
+        "enabled": ("enabled", False),
+        "once": ("once", []),
+        "skip": ("skip", []),
+    }
+
+    def __init__(self, num, settings):
+        set_attr = super(AlarmSettings, self).__setattr__
+        set_attr("num", num)
+        for attribute, (suffix, default) in self.FIELDS.items():
+            set_attr(attribute, settings.get(AlarmSettings.option(num, suffix), default))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("AlarmSettings are read only, use SettingsStore.set()")
+
+    @staticmethod
+    def option(num, suffix):
+        return "alarm_{0:d}_{1:s}".format(num, suffix)
+
+    @staticmethod
+    def parse_option(option):
+        """ alarm number of an alarm option, None for other options """
+        parts = option.split("_", 2)
+        if (len(parts) == 3 and parts[0] == "alarm" and parts[1].isdigit()):
+            return int(parts[1])
+        return None
+
+
+class SettingsStore(object):
+
+    DEBOUNCE = 3.0 # seconds without changes before they are written
+
+    def __init__(self, filename, name=None, version=None, debounce=DEBOUNCE):
+        from easysettings import EasySettings
+
+        self.filename = filename
+        self.debounce = debounce
+        self._settings = EasySettings(filename, name=name, version=version)
+
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._timer = None
+        self._transaction_depth = 0
+
+        self.writes = 0 # number of times the file was written
+
+        self._alarms = {} # alarm number -> AlarmSettings
+        self._subscribers = [] # (prefix, callback)
+
+        atexit.register(self.commit)
+
+    def get(self, option, default=None):
+        with self._lock:
+            return self._settings.get(option, default)
+
+    def has_option(self, option):
+        with self._lock:
+            return self._settings.has_option(option)
+
+    def set(self, option, value):
+        with self._lock:
+            if (self._settings.has_option(option) and self._settings.get(option) == value):
+                return
+            self._settings.set(option, value)
+            self._dirty = True
+            self._schedule_flush()
+
+            alarm_num = AlarmSettings.parse_option(option)
+            if (alarm_num is not None):
+                self._alarms.pop(alarm_num, None)
+            callbacks = [callback for prefix, callback in self._subscribers if option.startswith(prefix)]
+
+        # outside the lock, callbacks may read or set settings themselves
+        for callback in callbacks:
+            callback(option, value)
+
+    # the name EasySettings uses, the saving is deferred here as well
+    setsave = set
+
+    def alarm(self, num):
+        """ AlarmSettings of alarm num """
+        with self._lock:
+            if (num not in self._alarms):
+                self._alarms[num] = AlarmSettings(num, self)
+            return self._alarms[num]
+
+    def subscribe(self, prefix, callback):
+        """ callback(option, value) is called after an option starting with
+            prefix changed. An empty prefix gets all changes.
+        """
+        with self._lock:
+            self._subscribers.append((prefix, callback))
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = [(prefix, subscribed) for prefix, subscribed in self._subscribers if subscribed != callback]
+
+    def begin(self):
+        """ start a transaction: nothing is written until the matching end() """
+        with self._lock:
+            self._transaction_depth += 1
+            self._cancel_timer()
+
+    def end(self):
+        """ end a transaction, the outermost one writes its changes at once """
+        with self._lock:
+            self._transaction_depth = max(0, self._transaction_depth - 1)
+            if (self._transaction_depth == 0):
+                self.commit()
+
+    @contextmanager
+    def transaction(self):
+        self.begin()
+        try:
+            yield self
+        finally:
+            self.end()
+
+    def commit(self):
+        """ write pending changes now """
+        with self._lock:
+            self._cancel_timer()
+            if (not self._dirty):
+                return
+            temp_filename = self.filename + ".tmp"
+            try:
+                self._settings.save(temp_filename)
+                with open(temp_filename, "rb+") as f:
+                    os.fsync(f.fileno())
+                os.replace(temp_filename, self.filename)
+            except (OSError, IOError) as error:
+                logging.error("could not save settings: {}".format(error))
+                return
+            finally:
+                # save() may have switched EasySettings over to the temp file
+                self._settings.configfile = self.filename
+            self._dirty = False
+            self.writes += 1
+
+    def _schedule_flush(self):
+        # caller holds self._lock
+        if (self._transaction_depth > 0):
+            return
+        self._cancel_timer()
+        self._timer = threading.Timer(self.debounce, self.commit)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self):
+        if (self._timer is not None):
+            self._timer.cancel()
+            self._timer = None
@@ -0,0 +1,149 @@
+import bisect
+import posixpath
+
+'''
+
+TitleCatalog: the playlist sorted for picking a song on the LCD
+
+The playlist is sorted by title, by artist or by folder. Every order is
+built the first time it is used and keeps, for every entry, its sort key
+and its group (first letter, artist, folder) in sorted lists, so jumping
+to the next group or to a prefix is a bisect.
+
+'''
+
+
+def tag(title, name):
+    """ a tag of a playlist entry, MPD hands out a list for repeated tags """
+    value = title.get(name)
+    if (isinstance(value, list)):
+        value = value[0] if value else None
+    return value
+
+
+def display_name(title):
+    """ title of a playlist entry, the file name if it has no title tag """
+    if (tag(title, "title")):
+        return tag(title, "title")
+    name = posixpath.basename(title.get("file", ""))
+    return posixpath.splitext(name)[0] or "?"
+
+
+def sort_key(text):
+    return text.strip().casefold()
+
+
+class TitleOrder(object):
+    """ one sort order of the catalogue. Slots are the places in this
+        order, positions the places in the playlist.
+    """
+
+    __slots__ = ("name", "catalog", "keys", "groups", "positions", "names", "_slots")
+
+    def __init__(self, name, entries, catalog):
+        # entries: (group, key, display name, playlist position)
+        entries = sorted(entries)
+        self.name = name
+        self.catalog = catalog
+        self.groups = [group for group, key, text, position in entries]
+        self.keys = [key for group, key, text, position in entries]
+        self.names = [text for group, key, text, position in entries]
+        self.positions = [position for group, key, text, position in entries]
+        self._slots = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def position(self, slot):
+        return self.positions[slot]
+
+    def display(self, slot):
+        return self.names[slot]
+
+    def group(self, slot):
+        return self.groups[slot]
+
+    def uri(self, slot):
+        return self.catalog.uri(self.positions[slot])
+
+    def slot_of(self, position):
+        """ slot of a playlist position, 0 if it is not in the playlist """
+        if (self._slots is None):
+            self._slots = dict((position, slot) for slot, position in enumerate(self.positions))
+        return self._slots.get(position, 0)
+
+    def slot_of_uri(self, uri):
+        return self.slot_of(self.catalog.position_of(uri))
+
+    def next_group(self, slot):
+        """ first slot of the group after the one of slot, wraps around """
+        next_slot = bisect.bisect_right(self.groups, self.groups[slot])
+        return 0 if next_slot >= len(self.groups) else next_slot
+
+    def previous_group(self, slot):
+        """ first slot of the group before the one of slot, wraps around """
+        start = bisect.bisect_left(self.groups, self.groups[slot])
+        if (start == 0):
+            start = len(self.groups)
+        return bisect.bisect_left(self.groups, self.groups[start - 1])
+
+    def find_group(self, group):
+        """ first slot of the group, or of the next one after it """
+        return min(bisect.bisect_left(self.groups, group), len(self.groups) - 1)
+
+
+class TitleCatalog(object):
+    """ built from the list get_titles_info() returns, once per version of
+        the playlist (Audio keeps it)
+    """
+
+    ORDERS = ["title", "artist", "folder"]
+
+    # for the display
+    ORDER_NAMES = {
+        "playlist": "Liste", # PlaylistWindow
+        "title": "Titel",
+        "artist": "Interpret",
+        "folder": "Ordner",
+    }
+
+    UNKNOWN_ARTIST = "unbekannt"
+
+    def __init__(self, titles):
+        self.titles = titles
+        self._orders = {}
+        self._positions = None # file -> playlist position
+
+    def __len__(self):
+        return len(self.titles)
+
+    def uri(self, position):
+        return self.titles[position].get("file", "")
+
+    def position_of(self, uri):
+        """ playlist position of the file uri, None if it is not in the playlist """
+        if (self._positions is None):
+            self._positions = dict((title.get("file"), position) for position, title in enumerate(self.titles))
+        return self._positions.get(uri)
+
+    def order(self, name):
+        if (name not in self._orders):
+            self._orders[name] = TitleOrder(name, self._entries(name), self)
+        return self._orders[name]
+
+    def _entries(self, name):
+        for position, title in enumerate(self.titles):
+            text = display_name(title)
+            key = sort_key(text)
+            if (name == "title"):
+                group = key[:1]
+            elif (name == "artist"):
+                artist = tag(title, "artist") or self.UNKNOWN_ARTIST
+                group = sort_key(artist)
+                text = "{0:s} - {1:s}".format(artist, text)
+            elif (name == "folder"):
+                group = posixpath.dirname(title.get("file", ""))
+                key = sort_key(posixpath.basename(title.get("file", "")))
+            else:
+                raise ValueError("unknown title order: {}".format(name))
+            yield (group, key, text, position)
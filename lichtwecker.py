@@ -10,7 +10,10 @@ Lichtwecker Project from Griesi for my beloved cousins C and S
 """
 import sys
 import time
-import helpers # own helpers
+import signal
+from helpers import profiler # own helpers, first: it starts the clock
+with profiler.phase("import helpers.classes"):
+    from helpers.classes import LichtWecker
 import locale
 
 # sys.path.append(r'/home/pi/pysrc')
@@ -24,11 +27,17 @@ import locale
 # Main function
 def main(argv):
 
+    # exit cleanly on SIGTERM, so pending settings get written (atexit)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     # for German weekday names (locale must be installed within Linux already)
     locale.setlocale(locale.LC_ALL, 'de_DE') 
 
-    lichtwecker = helpers.LichtWecker()
-    lichtwecker.start()
+    # LW_PROFILE_STARTUP=1 reports where the start time goes
+    with profiler.phase("create LichtWecker"):
+        lichtwecker = LichtWecker()
+    with profiler.phase("start event loop"):
+        lichtwecker.start()
     print ("Lichtwecker object created and started")
     while 1:
         time.sleep(1)